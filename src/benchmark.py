@@ -0,0 +1,317 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import time
+
+import cv2
+import numpy as np
+
+from coarse_stab import feature_params, flow_params, generate_stabilized_video, read_video
+from optimizer import banded_optimize_path, cvx_optimize_path, offline_optimize_path, online_optimize_path
+from output_sink import OutputSink
+from propagation import propagate, warp_frame
+from utils import mkdir_if_not_exist
+
+STAGES = ['read_video', 'propagate', 'warp_frame', 'online_optimize_path', 'offline_optimize_path', 'banded_optimize_path',
+          'cvx_optimize_path', 'generate_stabilized_video', 'superpoint_run']
+
+
+class NullSink(OutputSink):
+    """ Discards frames, so that generate_stabilized_video is timed without the encoder. """
+
+    def __init__(self):
+        self.frame_num = 0
+
+    def write(self, frame):
+        self.frame_num += 1
+
+
+def camera_path(frames, seed=0, shake=4.0, shake_angle=0.01, pan=0.5):
+    """
+    Input:
+    frames: number of frames
+    seed: seed of the random shake, the same seed gives the same path
+    shake: standard deviation of the shake in pixels
+    shake_angle: standard deviation of the rotational shake in radians
+    pan: intended horizontal pan in pixels per frame
+
+    Output:
+    path: frames*3 array of the camera pose [dx, dy, da] of every frame, a slow pan plus
+        low-pass filtered random shake
+    """
+
+    rng = np.random.RandomState(seed)
+    noise = rng.randn(frames + 8, 3)
+    # smooth the white noise over a few frames, hand-held shake is not independent per frame
+    kernel = np.ones(5) / 5
+    noise = np.stack([np.convolve(noise[:, i], kernel, mode='same') for i in range(3)], axis=1)[4:frames + 4]
+    noise /= noise.std(axis=0) + 1e-12
+
+    path = noise * np.array([shake, shake, shake_angle])
+    path[:, 0] += pan * np.arange(frames)
+    return path
+
+
+def synthetic_scene(width, height, seed=0):
+    """
+    Output:
+    scene: height*width*3 uint8 textured image with blobs and rectangles, so that corner detection and
+        optical flow behave as on a natural video
+    """
+
+    rng = np.random.RandomState(seed)
+    scene = cv2.GaussianBlur(rng.randint(0, 256, (height, width, 3)).astype(np.uint8), (0, 0), 3)
+    for _ in range((width * height) // 4000):
+        color = tuple(int(c) for c in rng.randint(0, 256, 3))
+        x, y = int(rng.randint(0, width)), int(rng.randint(0, height))
+        size = int(rng.randint(4, 40))
+        if rng.rand() < 0.5:
+            cv2.rectangle(scene, (x, y), (x + size, y + size), color, -1)
+        else:
+            cv2.circle(scene, (x, y), size // 2, color, -1)
+    return scene
+
+
+def synthetic_video(path, width, height, frames, seed=0, fps=25):
+    """
+    Input:
+    path: .avi file the clip is written to, the camera path is saved next to it as .npy
+    width, height: frame size
+    frames: number of frames
+    seed: seed of the scene and the camera path, clips are deterministic for a given seed
+
+    Output:
+    camera: frames*3 array of the known camera pose [dx, dy, da] of every frame, see camera_path
+    """
+
+    camera = camera_path(frames, seed)
+    margin = int(np.abs(camera[:, :2]).max()) + 32
+    scene = synthetic_scene(width + 2 * margin, height + 2 * margin, seed)
+    center = (scene.shape[1] / 2, scene.shape[0] / 2)
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    for dx, dy, da in camera:
+        # camera pose -> affine map of the scene, cropped to the frame
+        M = cv2.getRotationMatrix2D(center, np.degrees(da), 1.0)
+        M[:, 2] -= [margin + dx, margin + dy]
+        writer.write(cv2.warpAffine(scene, M, (width, height), borderMode=cv2.BORDER_REFLECT))
+    writer.release()
+
+    np.save(os.path.splitext(path)[0] + '.npy', camera)
+    return camera
+
+
+def time_stage(func, repeats=3):
+    """
+    Input:
+    func: callable running the stage once
+    repeats: number of timed runs
+
+    Output:
+    timing: dict with the median and min wall time of the runs in seconds, the stage's own prints
+        (utils.timer) are suppressed
+    result: the return value of the last run
+    """
+
+    durations = []
+    for _ in range(repeats):
+        with contextlib.redirect_stdout(io.StringIO()):
+            time_start = time.perf_counter()
+            result = func()
+            durations.append(time.perf_counter() - time_start)
+    return dict(median=float(np.median(durations)), min=float(np.min(durations)), repeats=repeats), result
+
+
+def benchmark_case(video_path, patch_size=16, border=20, repeats=3, stages=STAGES, superpoint_weights=None, cvx_shape=(2, 2, 30)):
+    """
+    Input:
+    video_path: clip to benchmark, see synthetic_video
+    stages: names of the stages to time, see STAGES
+    superpoint_weights: pretrained SuperPoint weights, superpoint_run is skipped without them
+    cvx_shape: (rows, cols, frames) slice of the paths cvx_optimize_path is timed on, it solves one
+        cvxpy problem per vertex
+
+    Output:
+    results: dict stage -> timing, per-frame stages also hold the number of frames, ms per frame and fps
+    """
+
+    video = cv2.VideoCapture(video_path)
+    frames = []
+    while True:
+        flag, frame = video.read()
+        if not flag:
+            break
+        frames.append(frame)
+    video.release()
+    frame_count = len(frames)
+    results = {}
+
+    def record(stage, func, count=None, shape=None):
+        timing, result = time_stage(func, repeats)
+        if count is not None:
+            timing.update(frames=count, ms_per_frame=1000 * timing['median'] / count, fps=count / timing['median'])
+        if shape is not None:
+            timing['shape'] = list(shape)
+        results[stage] = timing
+        return result
+
+    # motion of the whole clip, also the input of the optimizers and the warp
+    def run_read_video():
+        capture = cv2.VideoCapture(video_path)
+        motion = read_video(capture, patch_size)
+        capture.release()
+        return motion
+
+    if 'read_video' in stages:
+        motion = record('read_video', run_read_video, frame_count - 1)
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            motion = run_read_video()
+    paths = np.stack((motion.x_paths, motion.y_paths))
+
+    # matched points of every frame pair, so that propagate is timed without the optical flow
+    grays = [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in frames]
+    matches = []
+    for prev_gray, curr_gray in zip(grays[:-1], grays[1:]):
+        prev_pts = cv2.goodFeaturesToTrack(prev_gray, mask=None, **feature_params)
+        curr_pts, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, curr_gray, prev_pts, None, **flow_params)
+        matches.append((prev_pts[status == 1], curr_pts[status == 1]))
+
+    if 'propagate' in stages:
+        record('propagate', lambda: [propagate(prev_pts, curr_pts, frame, patch_size)
+                                     for (prev_pts, curr_pts), frame in zip(matches, frames[1:])], len(matches))
+
+    if 'warp_frame' in stages:
+        record('warp_frame', lambda: [warp_frame(frame, motion.x_motion_patches[:, :, t], motion.y_motion_patches[:, :, t], patch_size)
+                                      for t, frame in enumerate(frames[:motion.length])], motion.length)
+
+    if 'online_optimize_path' in stages:
+        opt_paths = record('online_optimize_path', lambda: online_optimize_path(paths), paths.shape[-1], paths.shape)
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            opt_paths = online_optimize_path(paths)
+    if 'offline_optimize_path' in stages:
+        record('offline_optimize_path', lambda: [offline_optimize_path(p) for p in paths], paths.shape[-1], paths.shape)
+    if 'banded_optimize_path' in stages:
+        record('banded_optimize_path', lambda: banded_optimize_path(paths), paths.shape[-1], paths.shape)
+    if 'cvx_optimize_path' in stages:
+        rows, cols, length = cvx_shape
+        cvx_paths = np.ascontiguousarray(motion.x_paths[:rows, :cols, :length])
+        record('cvx_optimize_path', lambda: cvx_optimize_path(cvx_paths), cvx_paths.shape[-1], cvx_paths.shape)
+
+    if 'generate_stabilized_video' in stages:
+        x_motion_patches, y_motion_patches = motion.frame_warp_patches()
+        new_x_motion_patches = opt_paths[0] - motion.x_paths
+        new_y_motion_patches = opt_paths[1] - motion.y_paths
+
+        def run_generate():
+            capture = cv2.VideoCapture(video_path)
+            generate_stabilized_video(capture, x_motion_patches, y_motion_patches, new_x_motion_patches, new_y_motion_patches,
+                                      '', '', patch_size, border, NullSink())
+            capture.release()
+
+        record('generate_stabilized_video', run_generate, new_x_motion_patches.shape[2])
+
+    if 'superpoint_run' in stages:
+        if superpoint_weights and os.path.exists(superpoint_weights):
+            from superpoint import SuperPointWrapper
+            net = SuperPointWrapper(superpoint_weights)
+            imgs = [gray.astype(np.float32) / 255. for gray in grays]
+            record('superpoint_run', lambda: [net.run(img) for img in imgs], len(imgs))
+            record('superpoint_keypoints', lambda: [net.run(img, descriptors=False, heatmap=False) for img in imgs], len(imgs))
+        else:
+            results['superpoint_run'] = dict(skipped='no SuperPoint weights at ' + str(superpoint_weights))
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Input:
+    results, baseline: benchmark results as written by run_benchmarks
+    tolerance: relative change of the median time below which a stage counts as unchanged
+
+    Output:
+    rows: (case, stage, baseline s, current s, speed-up, verdict) for the stages present in both,
+        also printed as a table
+    """
+
+    rows = []
+    for case, stages in results['cases'].items():
+        for stage, timing in stages.items():
+            base = baseline['cases'].get(case, {}).get(stage)
+            if base is None or 'median' not in base or 'median' not in timing:
+                continue
+            speedup = base['median'] / timing['median']
+            if speedup > 1 + tolerance:
+                verdict = 'faster'
+            elif speedup < 1 / (1 + tolerance):
+                verdict = 'SLOWER'
+            else:
+                verdict = ''
+            rows.append((case, stage, base['median'], timing['median'], speedup, verdict))
+
+    print('{0:<22} {1:<26} {2:>10} {3:>10} {4:>8}'.format('case', 'stage', 'baseline', 'current', 'speed-up'))
+    for case, stage, base, current, speedup, verdict in rows:
+        print('{0:<22} {1:<26} {2:>10.4f} {3:>10.4f} {4:>7.2f}x {5}'.format(case, stage, base, current, speedup, verdict))
+    return rows
+
+
+def run_benchmarks(cases, work_dir, repeats=3, stages=STAGES, superpoint_weights=None, seed=0):
+    """
+    Input:
+    cases: list of (width, height, frames) of the synthetic clips
+    work_dir: directory of the generated clips, existing clips are reused
+
+    Output:
+    results: dict with the environment under 'meta' and the timings of every clip under 'cases'
+    """
+
+    mkdir_if_not_exist(work_dir)
+    results = dict(meta=dict(time=time.strftime('%Y-%m-%d %H:%M:%S'), python=platform.python_version(), platform=platform.platform(),
+                             numpy=np.__version__, cv2=cv2.__version__, cpu_count=os.cpu_count(), repeats=repeats, seed=seed),
+                   cases={})
+    for width, height, frames in cases:
+        case = '{0}x{1}x{2}'.format(width, height, frames)
+        video_path = os.path.join(work_dir, 'synthetic_{0}_{1}.avi'.format(case, seed))
+        if not os.path.exists(video_path):
+            print('generate ' + video_path)
+            synthetic_video(video_path, width, height, frames, seed)
+        print('benchmark ' + case + '...')
+        results['cases'][case] = benchmark_case(video_path, repeats=repeats, stages=stages, superpoint_weights=superpoint_weights)
+    return results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Per-stage benchmarks on synthetic shaky videos')
+
+    parser.add_argument('--cases', default=['320x240x60', '640x360x120'], nargs='+', type=str, help='synthetic clips as WIDTHxHEIGHTxFRAMES')
+    parser.add_argument('--work_dir', default='./benchmark/', type=str, help='generated clips are kept here')
+    parser.add_argument('--output', default='./benchmark/results.json', type=str, help='results are written to this JSON file')
+    parser.add_argument('--baseline', default='', type=str, help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='relative change of the median time reported as faster / slower')
+    parser.add_argument('--repeats', default=3, type=int, help='timed runs of every stage, the median is compared')
+    parser.add_argument('--stages', default=STAGES, nargs='+', choices=STAGES, help='stages to time')
+    parser.add_argument('--superpoint_weights', default='../pretrained_model/superpoint_v1.pth', type=str)
+    parser.add_argument('--seed', default=0, type=int, help='seed of the synthetic scene and camera path')
+
+    return parser
+
+
+if __name__ == '__main__':
+
+    args = get_parser().parse_args()
+    cases = [tuple(int(v) for v in case.split('x')) for case in args.cases]
+
+    results = run_benchmarks(cases, args.work_dir, args.repeats, args.stages, args.superpoint_weights, args.seed)
+    mkdir_if_not_exist(os.path.dirname(os.path.abspath(args.output)))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to ' + args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f), args.tolerance)
@@ -1,110 +1,306 @@
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import numpy as np
 
-from propagation import propagate, vertex_motion_path, warp_frame
-from optimizer import online_optimize_path
-from utils import save_motion_vectors, timer
-
+from motion_store import MotionStore, copy_time_blocks
+from profiling import count, span
+from propagation import mesh_vertices, propagate, warp_frame
+from tracker import FeatureTracker, shi_tomasi_detector
+from optimizer import OnlinePathOptimizer, banded_optimize_path, offline_optimize_path, online_optimize_path
+from utils import timer
 
-@timer
-def read_video(video, patch_size):
+# parameters for ShiTomasi corner detection
+feature_params = dict(maxCorners=400, qualityLevel=0.01, minDistance=7, blockSize=7)
 
-    # parameters for ShiTomasi corner detection
-    feature_params = dict(maxCorners=400, qualityLevel=0.01, minDistance=7, blockSize=7)
+# parameters for lucas kanade optical flow
+flow_params = dict(winSize=(15, 15), maxLevel=2, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
 
-    # parameters for lucas kanade optical flow
-    flow_params = dict(winSize=(15, 15), maxLevel=2, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
 
-    # Take first frame
-    video.set(cv2.CAP_PROP_POS_FRAMES, 0)
-    _, prev_frame = video.read()
-    prev_gray = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2GRAY)
-    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+def feature_tracker():
+    """ FeatureTracker with the corner detection and optical flow parameters of estimate_motion. """
+    return FeatureTracker(shi_tomasi_detector(feature_params), flow_params,
+                          max_features=feature_params['maxCorners'], min_distance=feature_params['minDistance'])
 
-    # motion patches in x-direction and y-direction
-    x_motion_patches, y_motion_patches = [], []
-    
-    # path parameters
-    x_paths = np.zeros((prev_frame.shape[0] // patch_size, prev_frame.shape[1] // patch_size, 1))
-    y_paths = np.zeros((prev_frame.shape[0] // patch_size, prev_frame.shape[1] // patch_size, 1))
 
-    for frame_num in range(1, frame_count):
-        # processing frames
-        flag, curr_frame = video.read()
+def estimate_motion(prev_gray, curr_gray, curr_frame, tracker=None, dtype=np.float64, return_homography=False, propagation_radius=300, patch_size=16):
+    """
+    Input:
+    prev_gray, curr_gray: consecutive grayscale frames
+    curr_frame: the current frame
+    tracker: optional FeatureTracker carrying tracks across frames, corners are detected on every frame otherwise
+    dtype: dtype of the motion patches
+    return_homography: return the global homography of the frame pair as well
+    propagation_radius: radius in pixels within which feature motion is propagated to mesh vertices
+    patch_size: mesh patch size in pixels
 
-        if not flag:
-            break
-        curr_gray = cv2.cvtColor(curr_frame, cv2.COLOR_BGR2GRAY)
+    Output:
+    x_motion_patch, y_motion_patch: motion patch of the frame pair in x-direction and y-direction
+    H: global homography from prev to curr, if return_homography
+    """
 
+    if tracker is not None:
+        with span('track'):
+            prev_pts, curr_pts = tracker.track(prev_gray, curr_gray)
+    else:
         # find corners in it
-        prev_pts = cv2.goodFeaturesToTrack(prev_gray, mask=None, **feature_params)
+        with span('corner_detection'):
+            prev_pts = cv2.goodFeaturesToTrack(prev_gray, mask=None, **feature_params)
 
         # calculate optical flow
-        curr_pts, status, err = cv2.calcOpticalFlowPyrLK(prev_gray, curr_gray, prev_pts, None, **flow_params)
+        with span('optical_flow'):
+            curr_pts, status, err = cv2.calcOpticalFlowPyrLK(prev_gray, curr_gray, prev_pts, None, **flow_params)
 
         # Select good points
         curr_pts, prev_pts = curr_pts[status==1], prev_pts[status==1]
+    count('features_tracked', len(prev_pts))
+
+    # estimate motion mesh for old_frame
+    with span('propagate'):
+        return propagate(prev_pts, curr_pts, curr_frame, PATCH_SIZE=patch_size, PROP_R=propagation_radius, dtype=dtype, return_homography=return_homography)
+
+
+def stabilize_frame(frame, new_x_motion_patch, new_y_motion_patch, border, patch_size=16):
+    """
+    Input:
+    frame: the frame to be stabilized
+    new_x_motion_patch, new_y_motion_patch: updated motion vectors on mesh vertices to be warped with
+    border: border cropped after warping
+    patch_size: mesh patch size in pixels
+
+    Output:
+    new_frame: the warped, cropped and resized frame
+    """
 
-        # estimate motion mesh for old_frame
-        x_motion_patch, y_motion_patch = propagate(prev_pts, curr_pts, curr_frame)
+    with span('stabilize_frame'):
+        new_frame = warp_frame(frame, new_x_motion_patch, new_y_motion_patch, patch_size)
+        new_frame = new_frame[border:-border, border:-border, :]
+        with span('resize'):
+            new_frame = cv2.resize(new_frame, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_CUBIC)
+
+    return new_frame
+
+
+def save_stabilized_frame(frame, new_frame, frame_num, x_motion_patch, y_motion_patch, new_x_motion_patch, new_y_motion_patch, x_motion_vector_path, new_x_motion_vector_path, PATCH_SIZE, sink, debug=None):
+    with span('sink_write'):
+        sink.write(new_frame)
+    # motion vector frames are debug artifacts, written in the background when enabled
+    if debug is not None:
+        debug.save_motion_vectors(x_motion_patch, y_motion_patch, PATCH_SIZE, x_motion_vector_path, frame_num, frame, r=5)
+        debug.save_motion_vectors(new_x_motion_patch, new_y_motion_patch, PATCH_SIZE, new_x_motion_vector_path, frame_num, new_frame, r=5)
+
+
+@timer
+def read_video(video, patch_size, start=0, end=None, workers=1, tracker=None, checkpoint=None, storage=None, dtype=np.float64, propagation_radius=300):
+    """
+    Input:
+    video: cv2.VideoCapture object of the given video
+    patch_size: block of size in patch
+    start, end: frame range [start, end) to read, the whole video by default
+    workers: number of processes estimating the motion of frame pairs; the decoder feeds them pairs,
+        the patches are collected in order and the paths are built at the end with one cumulative sum
+    tracker: optional FeatureTracker for persistent tracks, which are sequential and need workers=1
+    checkpoint: optional MotionCheckpoint, the motion patches are saved to it periodically and reading
+        resumes after the last saved frame
+    storage: storage of the MotionStore arrays, in RAM by default, see motion_store.MemmapStorage
+    dtype: precision of the motion patches and paths, float32 halves their memory
+    propagation_radius: motion propagation radius, see estimate_motion
+
+    Output:
+    motion: MotionStore with motion patches and vertex paths in x-direction and y-direction
+    """
+
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    if end is not None:
+        frame_count = min(frame_count, end)
+    frame_count -= start
+
+    # resume an interrupted run
+    motion = checkpoint.load(frame_count - 1, storage) if checkpoint is not None else None
+    resumed = motion.length if motion is not None else 0
+
+    # Take first frame
+    video.set(cv2.CAP_PROP_POS_FRAMES, start + resumed)
+    _, prev_frame = video.read()
+    prev_gray = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2GRAY)
+
+    # motion patches in x-direction and y-direction and their paths, preallocated for the whole video
+    if motion is None:
+        motion = MotionStore(prev_frame.shape[0] // patch_size, prev_frame.shape[1] // patch_size, frame_count - 1, dtype, storage)
 
-        try:
-            x_motion_patches = np.concatenate((x_motion_patches, np.expand_dims(x_motion_patch, axis=2)), axis=2)
-            y_motion_patches = np.concatenate((y_motion_patches, np.expand_dims(y_motion_patch, axis=2)), axis=2)
-        except:
-            x_motion_patches = np.expand_dims(x_motion_patch, axis=2)
-            y_motion_patches = np.expand_dims(y_motion_patch, axis=2)
+    if workers > 1 and tracker is not None:
+        raise ValueError('Persistent feature tracks need sequential motion estimation (workers=1)')
+
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.get_context('spawn').Pool(workers, initializer=cv2.setNumThreads, initargs=(1,))
+    pending = deque()
+
+    for frame_num in range(1 + resumed, frame_count):
+        # processing frames
+        with span('decode'):
+            flag, curr_frame = video.read()
 
-        # generate vertex profiles
-        x_paths, y_paths = vertex_motion_path(x_paths, y_paths, x_motion_patch, y_motion_patch)
+            if not flag:
+                break
+            curr_gray = cv2.cvtColor(curr_frame, cv2.COLOR_BGR2GRAY)
+
+        if pool is None:
+            # estimate motion mesh for old_frame
+            with span('estimate_motion'):
+                x_motion_patch, y_motion_patch, H = estimate_motion(prev_gray, curr_gray, curr_frame, tracker, dtype, True, propagation_radius, patch_size)
+
+            # store motion patches and generate vertex profiles
+            motion.append(x_motion_patch, y_motion_patch, homography=H)
+        else:
+            # propagate only needs the frame size, so the gray frame stands in for curr_frame
+            pending.append(pool.apply_async(estimate_motion, (prev_gray, curr_gray, curr_gray, None, dtype, True, propagation_radius, patch_size)))
+            while len(pending) >= 2 * workers:
+                with span('wait_workers'):
+                    x_motion_patch, y_motion_patch, H = pending.popleft().get()
+                motion.append(x_motion_patch, y_motion_patch, update_paths=False, homography=H)
+
+        if checkpoint is not None:
+            checkpoint.update(motion)
 
         # updates frames
         prev_frame = curr_frame.copy()
         prev_gray = curr_gray.copy()
 
-    return [x_motion_patches, y_motion_patches, x_paths, y_paths]
+    if pool is not None:
+        while pending:
+            x_motion_patch, y_motion_patch, H = pending.popleft().get()
+            motion.append(x_motion_patch, y_motion_patch, update_paths=False, homography=H)
+        pool.close()
+        pool.join()
+        motion.build_paths()
+
+    return motion
 
 @timer
-def stabilize(x_paths, y_paths):
+def stabilize(x_paths, y_paths, optimizer='online', storage=None):
     """
     Input:
     x_paths: motion vector accumulation on patch vertices in x-direction
     y_paths: motion vector accumulation on patch vertices in y-direction
+    optimizer: 'online' (sliding buffer Jacobi), 'offline' (full window Jacobi) or 'banded' (exact banded solve)
+    storage: optional storage of the optimized paths; the paths are then optimized one frame (online)
+        or one mesh row of a vertex-major copy (offline, banded) at a time instead of all at once, see motion_store.MemmapStorage
     
     Output:
     opt_x_paths, opt_y_paths: optimized paths in x-direction and y-direction
     """
 
-    opt_x_paths = online_optimize_path(x_paths)
-    opt_y_paths = online_optimize_path(y_paths)
+    if storage is not None:
+        opt_x_paths = storage.empty(x_paths.shape, x_paths.dtype)
+        opt_y_paths = storage.empty(y_paths.shape, y_paths.dtype)
+        if optimizer == 'online':
+            online = OnlinePathOptimizer((2,) + x_paths.shape[:-1], dtype=x_paths.dtype)
+            for t in range(x_paths.shape[-1]):
+                opt_x_paths[..., t], opt_y_paths[..., t] = online.update(np.stack((x_paths[..., t], y_paths[..., t])))
+        elif optimizer in ('banded', 'offline'):
+            optimize_path = banded_optimize_path if optimizer == 'banded' else offline_optimize_path
+            # a vertex-major scratch copy keeps every mesh row contiguous on disk, the rows are optimized in
+            # place and copied back to the time-major layout of the frame warping
+            for paths, opt_paths in ((x_paths, opt_x_paths), (y_paths, opt_y_paths)):
+                vertex_paths = storage.empty(paths.shape, paths.dtype, vertex_major=True)
+                copy_time_blocks(paths, vertex_paths)
+                for i in range(paths.shape[0]):
+                    vertex_paths[i:i+1] = optimize_path(np.array(vertex_paths[i:i+1]))
+                copy_time_blocks(vertex_paths, opt_paths)
+                storage.release(vertex_paths)
+        else:
+            raise ValueError('Unknown optimizer: ' + optimizer)
+        return [opt_x_paths, opt_y_paths]
+
+    # optimize x and y paths in the same batch
+    if optimizer == 'online':
+        opt_x_paths, opt_y_paths = online_optimize_path(np.stack((x_paths, y_paths)))
+    elif optimizer == 'banded':
+        opt_x_paths, opt_y_paths = banded_optimize_path(np.stack((x_paths, y_paths)))
+    elif optimizer == 'offline':
+        opt_x_paths = offline_optimize_path(x_paths)
+        opt_y_paths = offline_optimize_path(y_paths)
+    else:
+        raise ValueError('Unknown optimizer: ' + optimizer)
 
     return [opt_x_paths, opt_y_paths]
 
 @timer
-def get_frame_warp(x_motion_patches, y_motion_patches, x_paths, y_paths, opt_x_paths, opt_y_paths):
+def get_frame_warp(motion, opt_x_paths, opt_y_paths, storage=None):
     """
     Input
-    x_motion_patches: motion vectors on patch vertices in x-direction
-    y_motion_patches: motion vectors on patch vertices in y-direction
-    x_paths: motion vector accumulation on patch vertices in x-direction
-    y_paths: motion vector accumulation on patch vertices in y-direction    
+    motion: MotionStore with motion patches and motion vector accumulation on patch vertices
     opt_x_paths: optimized motion vector accumulation in x-direction
     opt_y_paths: optimized motion vector accumulation in x-direction
+    storage: optional storage of the updated motion patches, in RAM by default
     
     Output:
     Updated motion patches for each frame with which that needs to be warped
     """
 
-    x_motion_patches = np.concatenate((x_motion_patches, np.expand_dims(x_motion_patches[:, :, -1], axis=2)), axis=2)
-    y_motion_patches = np.concatenate((y_motion_patches, np.expand_dims(y_motion_patches[:, :, -1], axis=2)), axis=2)
-    new_x_motion_patches = opt_x_paths - x_paths
-    new_y_motion_patches = opt_y_paths - y_paths
+    x_motion_patches, y_motion_patches = motion.frame_warp_patches()
+    if storage is None:
+        new_x_motion_patches = opt_x_paths - motion.x_paths
+        new_y_motion_patches = opt_y_paths - motion.y_paths
+    else:
+        new_x_motion_patches = storage.empty(opt_x_paths.shape, opt_x_paths.dtype)
+        new_y_motion_patches = storage.empty(opt_y_paths.shape, opt_y_paths.dtype)
+        np.subtract(opt_x_paths, motion.x_paths, out=new_x_motion_patches)
+        np.subtract(opt_y_paths, motion.y_paths, out=new_y_motion_patches)
 
     return x_motion_patches, y_motion_patches, new_x_motion_patches, new_y_motion_patches
 
 
 @timer
-def generate_stabilized_video(video, x_motion_patches, y_motion_patches, new_x_motion_patches, new_y_motion_patches, x_motion_vector_path, new_x_motion_vector_path, PATCH_SIZE, border, output_dir):
+def frame_transforms(motion, new_x_motion_patches, new_y_motion_patches, patch_size, border, frame_size, chunk=1024):
+    """
+    Residual global motion between consecutive stabilized frames, from the homographies read_video estimated,
+    so that fine_stab doesn't need to estimate it again.
+
+    Input:
+    motion: MotionStore with the global homographies of the frame pairs
+    new_x_motion_patches, new_y_motion_patches: updated motion patches of get_frame_warp
+    patch_size: block of size in patch
+    border: border cropped after warping
+    frame_size: (height, width) of the frames
+    chunk: frames whose mesh warps are fitted at once
+
+    Output:
+    transforms: (frames - 1)*3 array of [dx, dy, da] from every stabilized frame to the next, like the
+    transforms fine_stab estimates with estimateAffine2D
+    """
+
+    height, width = frame_size
+    frame_count = new_x_motion_patches.shape[2]
+
+    # stabilized frame pixel -> warped frame pixel, undoing the crop and cv2.resize of stabilize_frame
+    sx, sy = (width - 2 * border) / width, (height - 2 * border) / height
+    crop = np.array([[sx, 0, 0.5 * sx - 0.5 + border], [0, sy, 0.5 * sy - 0.5 + border], [0, 0, 1]])
+
+    # warped frame pixel -> input frame pixel: affine least squares fit of the mesh warp p -> p + new motion
+    vertices = mesh_vertices(motion.rows, motion.cols, patch_size).astype(np.float64)
+    fit = np.linalg.pinv(np.column_stack((vertices, np.ones(len(vertices)))))
+    warps = np.zeros((frame_count, 3, 3))
+    warps[:, 2, 2] = 1
+    for start in range(0, frame_count, chunk):
+        end = min(start + chunk, frame_count)
+        for k, (new_motion_patches, vertex) in enumerate(((new_x_motion_patches, vertices[:, 0]), (new_y_motion_patches, vertices[:, 1]))):
+            target = vertex[:, None] + np.asarray(new_motion_patches[:, :, start:end], dtype=np.float64).reshape(-1, end - start)
+            warps[start:end, k, :] = np.dot(fit, target).T
+    warps = np.matmul(warps, crop)
+
+    # stabilized frame t -> input frame t -> input frame t+1 -> stabilized frame t+1
+    residual = np.matmul(np.linalg.inv(warps[1:]), np.matmul(motion.homographies[:frame_count - 1], warps[:-1]))
+    residual = residual / residual[:, 2:3, 2:3]
+
+    return np.stack((residual[:, 0, 2], residual[:, 1, 2], np.arctan2(residual[:, 1, 0], residual[:, 0, 0])), axis=1)
+
+
+@timer
+def generate_stabilized_video(video, x_motion_patches, y_motion_patches, new_x_motion_patches, new_y_motion_patches, x_motion_vector_path, new_x_motion_vector_path, PATCH_SIZE, border, sink, debug=None, start=0, workers=1):
     """
     Input:
     video: cv2.VideoCapture object of the given video
@@ -112,30 +308,121 @@ def generate_stabilized_video(video, x_motion_patches, y_motion_patches, new_x_m
     y_motion_patches: motion vectors on mesh vertices in y-direction
     new_x_motion_patches: updated motion vectors on mesh vertices in x-direction to be warped with
     new_y_motion_patches: updated motion vectors on mesh vertices in y-direction to be warped with
+    sink: output sink the stabilized frames are written to in order, see output_sink
+    debug: optional DebugArtifactWriter for motion vector frames, x_motion_patches and y_motion_patches are only read when it is set
+    start: index of the first frame the patches belong to
+    workers: number of threads warping frames in parallel; cv2.remap and the numpy map building release
+        the GIL, frames are handed to the sink in order through a reorder buffer
     """
 
     # get video properties
-    video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    video.set(cv2.CAP_PROP_POS_FRAMES, start)
 
-    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    frame_count = new_x_motion_patches.shape[2]
+
+    pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    pending = deque()
+
+    def save_next():
+        frame_num, frame, new_frame = pending.popleft()
+        if pool is not None:
+            with span('wait_workers'):
+                new_frame = new_frame.result()
+        x_motion_patch = x_motion_patches[:, :, frame_num - start] if debug is not None else None
+        y_motion_patch = y_motion_patches[:, :, frame_num - start] if debug is not None else None
+        new_x_motion_patch = new_x_motion_patches[:, :, frame_num - start]
+        new_y_motion_patch = new_y_motion_patches[:, :, frame_num - start]
+        save_stabilized_frame(frame, new_frame, frame_num, x_motion_patch, y_motion_patch, new_x_motion_patch, new_y_motion_patch, x_motion_vector_path, new_x_motion_vector_path, PATCH_SIZE, sink, debug)
 
-    for frame_num in range(frame_count):
+    for frame_num in range(start, start + frame_count):
         # reconstruct from frames
-        flag, frame = video.read()
+        with span('decode'):
+            flag, frame = video.read()
         if not flag:
             break
-        x_motion_patch = x_motion_patches[:, :, frame_num]
-        y_motion_patch = y_motion_patches[:, :, frame_num]
-        new_x_motion_patch = new_x_motion_patches[:, :, frame_num]
-        new_y_motion_patch = new_y_motion_patches[:, :, frame_num]
+        new_x_motion_patch = new_x_motion_patches[:, :, frame_num - start]
+        new_y_motion_patch = new_y_motion_patches[:, :, frame_num - start]
 
         # warping
-        new_frame = warp_frame(frame, new_x_motion_patch, new_y_motion_patch)
-        new_frame = new_frame[border:-border, border:-border, :]
-        new_frame = cv2.resize(new_frame, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_CUBIC)
+        if pool is None:
+            new_frame = stabilize_frame(frame, new_x_motion_patch, new_y_motion_patch, border, PATCH_SIZE)
+        else:
+            new_frame = pool.submit(stabilize_frame, frame, new_x_motion_patch, new_y_motion_patch, border, PATCH_SIZE)
+        pending.append((frame_num, frame, new_frame))
+
+        # keep at most two frames per worker in flight
+        while len(pending) > 2 * workers:
+            save_next()
+
+    while pending:
+        save_next()
+
+    if pool is not None:
+        pool.shutdown()
+    video.release()
+
+
+@timer
+def stream_stabilized_video(video, patch_size, border, x_motion_vector_path, new_x_motion_vector_path, sink, buffer_size=100, debug=None, tracker=None, dtype=np.float64, propagation_radius=300):
+    """
+    Single pass version of read_video, stabilize (online), get_frame_warp and generate_stabilized_video.
+    Every frame is decoded once, propagated, optimized over the sliding buffer and emitted with one frame
+    of lookahead (the motion patch of frame t is only known once frame t+1 is read), so memory stays
+    O(buffer_size) regardless of the clip length.
+
+    Input:
+    video: cv2.VideoCapture object of the given video
+    patch_size: block of size in patch
+    border: border cropped after warping
+    sink: output sink the stabilized frames are written to as soon as they are produced
+    buffer_size: sliding buffer of the online optimizer
+    debug: optional DebugArtifactWriter for motion vector frames
+    tracker: optional FeatureTracker for persistent tracks
+    dtype: precision of the paths and the optimizer state
+    propagation_radius: motion propagation radius, see estimate_motion
+    """
+
+    video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    flag, prev_frame = video.read()
+    if not flag:
+        video.release()
+        return
+    prev_gray = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2GRAY)
+
+    rows, cols = prev_frame.shape[0] // patch_size, prev_frame.shape[1] // patch_size
+
+    # x and y paths are optimized in the same batch, path of the first frame is zero
+    optimizer = OnlinePathOptimizer((2, rows, cols), buffer_size, dtype=dtype)
+    path = np.zeros((2, rows, cols), dtype)
+    new_motion_patch = optimizer.update(path) - path
+    motion_patch = np.zeros((2, rows, cols), dtype)
+
+    frame_num = 0
+    while True:
+        with span('decode'):
+            flag, curr_frame = video.read()
+            if not flag:
+                break
+            curr_gray = cv2.cvtColor(curr_frame, cv2.COLOR_BGR2GRAY)
+
+        # motion between the pending frame and the current one
+        with span('estimate_motion'):
+            motion_patch = np.stack(estimate_motion(prev_gray, curr_gray, curr_frame, tracker, dtype, propagation_radius=propagation_radius, patch_size=patch_size))
+
+        # emit the pending frame
+        new_frame = stabilize_frame(prev_frame, new_motion_patch[0], new_motion_patch[1], border, patch_size)
+        save_stabilized_frame(prev_frame, new_frame, frame_num, motion_patch[0], motion_patch[1], new_motion_patch[0], new_motion_patch[1], x_motion_vector_path, new_x_motion_vector_path, patch_size, sink, debug)
+
+        # generate vertex profiles and optimize the current frame
+        path = path + motion_patch
+        with span('optimize'):
+            new_motion_patch = optimizer.update(path) - path
+
+        frame_num += 1
+        prev_frame, prev_gray = curr_frame, curr_gray
 
-        cv2.imwrite(output_dir + str(frame_num).zfill(5) + '.png', new_frame)
-        save_motion_vectors(x_motion_patch, y_motion_patch, PATCH_SIZE, x_motion_vector_path, frame_num, frame, r=5)
-        save_motion_vectors(new_x_motion_patch, new_y_motion_patch, PATCH_SIZE, new_x_motion_vector_path, frame_num, new_frame, r=5)
+    # the last frame repeats the last motion patch
+    new_frame = stabilize_frame(prev_frame, new_motion_patch[0], new_motion_patch[1], border, patch_size)
+    save_stabilized_frame(prev_frame, new_frame, frame_num, motion_patch[0], motion_patch[1], new_motion_patch[0], new_motion_patch[1], x_motion_vector_path, new_x_motion_vector_path, patch_size, sink, debug)
 
     video.release()
@@ -0,0 +1,214 @@
+import argparse
+import glob
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from metrics import metrics_stream, video_frames
+from output_sink import sink_frames
+from utils import mkdir_if_not_exist
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# motion categories of the NUS dataset, as in bash/*.sh
+CATEGORIES = ['Regular', 'Crowd', 'Parallax', 'QuickRotation', 'Running', 'Zooming']
+
+# the columns of the summary table, averaged over the clips of a category
+SUMMARY_COLUMNS = ['clips', 'fps', 'wall_time', 'peak_rss_mb', 'cropping_ratio', 'distortion', 'stability']
+
+STAGE_PATTERN = re.compile(r'^(\w+) cost time ([0-9.eE+-]+) s$', re.MULTILINE)
+ELAPSED_PATTERN = re.compile(r'^Time elapsed:\s+([0-9.eE+-]+)$', re.MULTILINE)
+
+
+def dataset_clips(data_dir, categories=CATEGORIES, limit=0):
+    """
+    Input:
+    data_dir: dataset tree with one directory of numbered .avi clips per category, e.g. data/Regular/0.avi
+    categories: categories to run, missing ones are skipped
+    limit: number of clips per category, all when 0
+
+    Output:
+    clips: list of (category, clip name, video path) in numeric order
+    """
+
+    clips = []
+    for category in categories:
+        paths = glob.glob(os.path.join(data_dir, category, '*.avi'))
+        paths.sort(key=lambda p: (len(os.path.basename(p)), os.path.basename(p)))
+        if limit > 0:
+            paths = paths[:limit]
+        clips.extend((category, os.path.splitext(os.path.basename(p))[0], p) for p in paths)
+    return clips
+
+
+def run_tracked(cmd, log_path):
+    """
+    Input:
+    cmd: command line of the stabilizer, run from src/
+    log_path: its stdout and stderr are written here
+
+    Output:
+    run: dict with the exit code, wall time in seconds and peak resident set size in MB of the process,
+        the peak is the largest of the process and the children it waited for (e.g. worker pools)
+    """
+
+    with open(log_path, 'w') as log:
+        time_start = time.perf_counter()
+        process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, cwd=SRC_DIR)
+        # wait4 instead of wait, to get the resource usage of this one process
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_time = time.perf_counter() - time_start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss / 1024 if sys.platform != 'darwin' else usage.ru_maxrss / 1024**2
+    return dict(returncode=process.returncode, wall_time=wall_time, peak_rss_mb=peak_rss)
+
+
+def stage_timings(log_path):
+    """
+    Output:
+    timings: dict stage -> seconds, parsed from the utils.timer prints in the log, repeated stages are summed;
+        'elapsed' holds the time main.py reports itself, i.e. without interpreter start-up and imports
+    """
+
+    timings = {}
+    with open(log_path) as f:
+        log = f.read()
+    for stage, seconds in STAGE_PATTERN.findall(log):
+        timings[stage] = timings.get(stage, 0) + float(seconds)
+    for seconds in ELAPSED_PATTERN.findall(log):
+        timings['elapsed'] = float(seconds)
+    return timings
+
+
+def benchmark_clip(video_path, output_dir, main_args=(), vidstab=True, metrics_backend='sift'):
+    """
+    Input:
+    video_path: clip to stabilize
+    output_dir: output directory of the clip, the stabilized videos and logs are kept here
+    main_args: extra main.py arguments, e.g. ['--precision', 'float32']; the output of its --sink is scored
+    vidstab: stabilize the clip with the VidStab baseline as well
+    metrics_backend: feature backend of the metrics, empty to skip them
+
+    Output:
+    result: dict pipeline -> run, see run_tracked, with frames/s, stage timings and the metrics scores
+    """
+
+    video = cv2.VideoCapture(video_path)
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    video.release()
+
+    # the output is read back with the sink main_args ask for, one stabilized frame per input frame
+    sink_parser = argparse.ArgumentParser(add_help=False)
+    sink_parser.add_argument('--sink', default='video')
+    sink_kind = sink_parser.parse_known_args(main_args)[0].sink
+
+    main_cmd = [sys.executable, 'main.py', '--input_video', os.path.abspath(video_path), '--output_dir', output_dir, '--sink', 'video'] + list(main_args)
+    pipelines = [('coarse_stab', main_cmd, lambda: sink_frames(sink_kind, output_dir, frame_count=frame_count))]
+    if vidstab:
+        vidstab_cmd = [sys.executable, 'vidstab_test.py', '--input_video', os.path.abspath(video_path),
+                       '--output_path', output_dir + 'vidstab.avi', '--plot_dir', '']
+        pipelines.append(('vidstab', vidstab_cmd, lambda: video_frames(output_dir + 'vidstab.avi')))
+
+    result = {}
+    for name, cmd, stabilized_frames in pipelines:
+        log_path = output_dir + name + '.log'
+        run = run_tracked(cmd, log_path)
+        run.update(frames=frame_count, fps=frame_count / run['wall_time'], stages=stage_timings(log_path))
+        if run['returncode'] != 0:
+            print(name + ' failed, see ' + log_path)
+        elif metrics_backend:
+            scores = metrics_stream(video_frames(video_path), stabilized_frames(), metrics_backend)
+            run.update((key, float(value)) for key, value in scores.items())
+        result[name] = run
+    return result
+
+
+def summarize_categories(results):
+    """
+    Input:
+    results: list of per clip dicts with category, clip and the runs of benchmark_clip
+
+    Output:
+    summary: dict category -> pipeline -> mean of SUMMARY_COLUMNS over the successful clips,
+        plus an 'all' category over every clip
+    """
+
+    groups = {}
+    for result in results:
+        for category in (result['category'], 'all'):
+            for pipeline, run in result['runs'].items():
+                if run['returncode'] == 0:
+                    groups.setdefault(category, {}).setdefault(pipeline, []).append(run)
+
+    summary = {}
+    for category, pipelines in groups.items():
+        for pipeline, runs in pipelines.items():
+            row = dict(clips=len(runs))
+            for column in SUMMARY_COLUMNS[1:]:
+                values = [run[column] for run in runs if column in run]
+                row[column] = float(np.mean(values)) if values else None
+            summary.setdefault(category, {})[pipeline] = row
+    return summary
+
+
+def summary_table(summary):
+    """
+    Output:
+    table: markdown table of summarize_categories, one row per category and pipeline
+    """
+
+    lines = ['| category | pipeline | ' + ' | '.join(SUMMARY_COLUMNS) + ' |',
+             '|' + ' --- |' * (len(SUMMARY_COLUMNS) + 2)]
+    for category in sorted(summary, key=lambda c: (c == 'all', c)):
+        for pipeline, row in sorted(summary[category].items()):
+            cells = [str(row[c]) if isinstance(row[c], int) else '-' if row[c] is None else '{0:.4g}'.format(row[c]) for c in SUMMARY_COLUMNS]
+            lines.append('| ' + category + ' | ' + pipeline + ' | ' + ' | '.join(cells) + ' |')
+    return '\n'.join(lines)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Throughput and quality of the pipeline on the NUS dataset, per motion category')
+
+    parser.add_argument('--data_dir', default='../data/', type=str, help='dataset tree, data_dir/<category>/<n>.avi')
+    parser.add_argument('--output_dir', default='./dataset_benchmark/', type=str, help='stabilized videos, logs, results.json and summary.md')
+    parser.add_argument('--categories', default=CATEGORIES, nargs='+', type=str)
+    parser.add_argument('--limit', default=0, type=int, help='clips per category, all when 0')
+    parser.add_argument('--main_args', default='', type=str, help='extra main.py arguments as one string, e.g. --main_args="--precision float32 --optimizer banded"')
+    parser.add_argument('--no_vidstab', action='store_true', help='skip the VidStab baseline')
+    parser.add_argument('--metrics_backend', default='sift', choices=['sift', 'orb', 'orb_flann', ''], help='features of the metrics, empty to skip them')
+
+    return parser
+
+
+if __name__ == '__main__':
+
+    args = get_parser().parse_args()
+    output_dir = os.path.abspath(args.output_dir) + '/'
+    mkdir_if_not_exist(output_dir)
+
+    results = []
+    for category, clip, video_path in dataset_clips(args.data_dir, args.categories, args.limit):
+        print('benchmark ' + category + '/' + clip + '...')
+        clip_dir = output_dir + category + '/' + clip + '/'
+        mkdir_if_not_exist(clip_dir)
+        runs = benchmark_clip(video_path, clip_dir, shlex.split(args.main_args), not args.no_vidstab, args.metrics_backend)
+        results.append(dict(category=category, clip=clip, video=video_path, runs=runs))
+
+        # rewritten after every clip, so that an interrupted run keeps its results
+        summary = summarize_categories(results)
+        with open(output_dir + 'results.json', 'w') as f:
+            json.dump(dict(main_args=args.main_args, metrics_backend=args.metrics_backend, clips=results, summary=summary), f, indent=2)
+
+    table = summary_table(summarize_categories(results))
+    with open(output_dir + 'summary.md', 'w') as f:
+        f.write(table + '\n')
+    print(table)
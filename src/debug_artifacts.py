@@ -0,0 +1,51 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import plot_vertex_path, save_motion_vectors
+
+
+class DebugArtifactWriter(object):
+    """
+    Renders and writes debug artifacts (motion vector frames, vertex path plots) on a background
+    thread pool, so the stabilization loop only pays for copying its inputs. Drawing with cv2 and
+    png encoding release the GIL, and the plots avoid pyplot's global state.
+
+    At most max_pending artifacts are in flight; submitting more waits for a worker to finish,
+    which bounds the memory held by queued frames.
+    """
+
+    def __init__(self, workers=2, max_pending=64):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.errors = []
+
+    def _done(self, future):
+        self.pending.release()
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+
+    def submit(self, func, *args):
+        self.pending.acquire()
+        future = self.pool.submit(func, *args)
+        future.add_done_callback(self._done)
+
+    def save_motion_vectors(self, x_motion_patch, y_motion_patch, PATCH_SIZE, x_motion_vector_path, frame_num, frame, r=5):
+        self.submit(save_motion_vectors, x_motion_patch.copy(), y_motion_patch.copy(), PATCH_SIZE, x_motion_vector_path, frame_num, frame.copy(), r)
+
+    def plot_vertex_motion(self, x_paths, opt_x_paths, save_path):
+        # one task per plotted vertex, same vertices as utils.plot_vertex_motion
+        for i in range(x_paths.shape[0]):
+            for j in range(0, x_paths.shape[1], 10):
+                self.submit(plot_vertex_path, x_paths[i, j, :].copy(), opt_x_paths[i, j, :].copy(), save_path + str(i) + '_' + str(j) + '.png')
+
+    def close(self):
+        """ Wait for all pending artifacts, re-raising the first failure. """
+        self.pool.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
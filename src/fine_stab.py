@@ -1,14 +1,17 @@
 
+from collections import deque
+
 import cv2
 import numpy as np
-from superpoint import SuperPointWrapper
+from superpoint import SuperPointWrapper, compiled_superpoint
+from tracker import FeatureTracker
 
 def movingAverage(curve, radius):
     window_size = 2 * radius + 1
     # Define filter
     f = np.ones(window_size) / window_size
     # Add padding to the boundaries
-    curve_pad = np.lib.pad(curve, (radius, radius), 'edge')
+    curve_pad = np.pad(curve, (radius, radius), 'edge')
     # Convolution
     curve_smoothed = np.convolve(curve_pad, f, mode='same')
     # Unpadding
@@ -26,6 +29,60 @@ def smooth(trajectory, radius=50):
     return smooth_trajectory
 
 
+class RunningAverage(object):
+    """
+    Streaming form of smooth: the centred moving average (edge padded) of trajectory samples pushed one
+    at a time, with radius samples of lookahead. The window sum is updated in O(1) per sample.
+    """
+
+    def __init__(self, radius=50):
+        self.radius = radius
+        self.window = deque()
+        self.sum = None
+        self.last = None
+
+    def _append(self, sample):
+        self.window.append(sample)
+        self.sum = self.sum + sample
+        if len(self.window) < 2 * self.radius + 1:
+            return None
+        average = self.sum / len(self.window)
+        self.sum = self.sum - self.window.popleft()
+        return average
+
+    def push(self, sample):
+        """
+        Input:
+        sample: trajectory sample i
+
+        Output:
+        average: smoothed sample i - radius, None while the first window is incomplete
+        """
+
+        sample = np.asarray(sample, dtype=np.float64)
+        if self.last is None:
+            # the first sample pads the window on the left
+            self.window.extend([sample] * self.radius)
+            self.sum = sample * self.radius
+        self.last = sample
+        return self._append(sample)
+
+    def flush(self):
+        """
+        Output:
+        averages: the remaining smoothed samples, the last sample pads the window on the right
+        """
+
+        averages = []
+        if self.last is None:
+            return averages
+        for _ in range(self.radius):
+            average = self._append(self.last)
+            if average is not None:
+                averages.append(average)
+        return averages
+
+
 def alternative_pts(prev_gray, curr_gray):
     prev_pts = cv2.goodFeaturesToTrack(prev_gray, maxCorners=200, qualityLevel=0.01, minDistance=7, blockSize=7)
 
@@ -36,6 +93,32 @@ def alternative_pts(prev_gray, curr_gray):
     
     return prev_pts, curr_pts
 
+def superpoint_detector(SPNet):
+    """ Keypoint detector for FeatureTracker, returning the strongest SuperPoint keypoints inside mask. """
+
+    def detect(gray, mask, max_corners):
+        pts, _, _ = SPNet.run(gray.astype('float32'), descriptors=False, heatmap=False)
+        pts = pts[:2, :].T
+        if mask is not None:
+            pts = pts[mask[pts[:, 1].astype(int), pts[:, 0].astype(int)] > 0]
+        return pts[:max_corners].astype('float32').reshape(-1, 1, 2)
+
+    return detect
+
+
+def calibration_frames(video, count=8):
+    """ count grayscale float32 frames spread over the video, for calibrating and checking a compiled SuperPoint """
+    n_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames = []
+    for i in np.linspace(0, max(n_frames - 1, 0), count).astype(int):
+        video.set(cv2.CAP_PROP_POS_FRAMES, i)
+        flag, frame = video.read()
+        if flag:
+            frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY).astype('float32'))
+    video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    return frames
+
+
 def fixBorder(frame):
     s = frame.shape
     # Scale the image 4% without moving the center
@@ -45,56 +128,95 @@ def fixBorder(frame):
     return frame
 
 
-def fine_stab(input_video, output_dir, weights_path = '../pretrained_model/superpoint_v1.pth', cuda = True):
+def fine_stab(input_video, sink, weights_path = '../pretrained_model/superpoint_v1.pth', cuda = True, persistent_tracks = False, threads = None, compiled_dir = None, quantize = 'static', radius = 50, transforms = None):
+    """
+    Single pass fine stabilization: frames are decoded once, the trajectory is accumulated incrementally
+    and smoothed by RunningAverage, and every frame is warped and written as soon as the radius frames
+    after it are known. Only radius + 1 frames are held in memory.
+
+    transforms: optional (frames - 1)*3 [dx, dy, da] between consecutive frames, e.g. the coarse stage's
+    coarse_stab.frame_transforms of input_video; no features are detected or tracked then
+    """
+
     # Read input video
     video = cv2.VideoCapture(input_video)
 
-    # Get frame count and fps
-    n_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-
     # Get width and height of video stream
     width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
+    # TorchScript / int8 SuperPoint for CPU hosts, exported once into compiled_dir
+    compiled_path = None
+    if compiled_dir is not None and transforms is None:
+        compiled_path = compiled_superpoint(weights_path, compiled_dir, calibration_frames(video), quantize)
+
     # Read the first frame
-    _, prev = video.read()
+    flag, prev = video.read()
+    if not flag:
+        video.release()
+        return
 
     # Convert frame to grayscale
     prev_gray = cv2.cvtColor(prev, cv2.COLOR_BGR2GRAY)
 
-    # Pre-define transformation-store array
-    transforms = np.zeros((n_frames-1, 3), np.float32)
-    
-    SPNet = SuperPointWrapper(weights_path=weights_path, cuda=cuda)
+    SPNet = None
+    if transforms is None:
+        SPNet = SuperPointWrapper(weights_path=weights_path, cuda=cuda, threads=threads, compiled_path=compiled_path)
 
-    for i in range(n_frames - 2):
-        # SuperPoint KeyPoints Detector
+    # Persistent tracks only run SuperPoint when the tracks run low or leave regions empty
+    tracker = None
+    if persistent_tracks and transforms is None:
+        tracker = FeatureTracker(superpoint_detector(SPNet), dict(winSize=(15, 15), maxLevel=2), max_features=1000, min_features=300)
 
-        prev_gray_float32 = prev_gray.astype('float32')
-        
-        prev_pts, _, _ = SPNet.run(prev_gray_float32)
-        
-        prev_pts = prev_pts.astype('float32').T
-        prev_pts = np.array([prev_pts[:, :2]])
-        prev_pts = np.transpose(prev_pts, (1, 0, 2))
+    # Frames waiting for their smoothing window, with their transformation and trajectory
+    pending = deque()
+    trajectory = np.zeros(3)
+    smoother = RunningAverage(radius)
 
-        if prev_pts.shape[0] <= 10:
-            prev_pts = cv2.goodFeaturesToTrack(prev_gray, maxCorners=200, qualityLevel=0.01, minDistance=7, blockSize=7)
+    def write_frame(smooth_trajectory):
+        frame, transform, frame_trajectory = pending.popleft()
 
-        # Read next frame
-        flag, curr = video.read()
-        if not flag:
-            break
+        # Calculate newer transformation from the difference in smoothed trajectory and trajectory
+        dx, dy, da = transform + smooth_trajectory - frame_trajectory
 
-        # Convert to grayscale
-        curr_gray = cv2.cvtColor(curr, cv2.COLOR_BGR2GRAY)
-        # Calculate optical flow (i.e. track feature points)
-        curr_pts, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, curr_gray, prev_pts, None, winSize=(15, 15), maxLevel=2)
+        # Reconstruct transformation matrix accordingly to new values
+        m = np.array([[np.cos(da), -np.sin(da), dx], [np.sin(da), np.cos(da), dy]])
 
-        # Filter only valid points
-        idx = np.where(status == 1)[0]
+        # Apply affine warping to the given frame
+        frame_stabilized = cv2.warpAffine(frame, m, (width, height))
 
-        prev_pts, curr_pts = prev_pts[idx], curr_pts[idx]
+        # Fix border artifacts
+        frame_stabilized = fixBorder(frame_stabilized)
+
+        # Write the frame to the output sink
+        frame_out = cv2.vconcat([frame, frame_stabilized])
+
+        sink.write(frame_out)
+
+    def estimate_transform(prev_gray, curr_gray):
+        if tracker is None:
+            # SuperPoint KeyPoints Detector
+
+            prev_gray_float32 = prev_gray.astype('float32')
+            
+            prev_pts, _, _ = SPNet.run(prev_gray_float32, descriptors=False, heatmap=False)
+            
+            prev_pts = prev_pts.astype('float32').T
+            prev_pts = np.array([prev_pts[:, :2]])
+            prev_pts = np.transpose(prev_pts, (1, 0, 2))
+
+            if prev_pts.shape[0] <= 10:
+                prev_pts = cv2.goodFeaturesToTrack(prev_gray, maxCorners=200, qualityLevel=0.01, minDistance=7, blockSize=7)
+
+            # Calculate optical flow (i.e. track feature points)
+            curr_pts, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, curr_gray, prev_pts, None, winSize=(15, 15), maxLevel=2)
+
+            # Filter only valid points
+            idx = np.where(status == 1)[0]
+
+            prev_pts, curr_pts = prev_pts[idx], curr_pts[idx]
+        else:
+            prev_pts, curr_pts = tracker.track(prev_gray, curr_gray)
 
         # If SuperPoint doesn't work well, we need alternative plan
         if prev_pts.shape[0] <= 10:
@@ -105,48 +227,39 @@ def fine_stab(input_video, output_dir, weights_path = '../pretrained_model/super
         # m = cv2.estimateAffinePartial2D(prev_pts, curr_pts)[0]
 
         # Estimate translation
-        dx, dy, da = m[0, 2], m[1, 2], np.arctan2(m[1, 0], m[0, 0])
-
-        # Store transformation
-        transforms[i] = [dx, dy, da]
-
-        # Move to next frame
-        prev_gray = curr_gray
-
-        # Compute trajectory using cumulative sum of transformations
-        trajectory = np.cumsum(transforms, axis=0)
-
-    trajectory = np.cumsum(transforms, axis=0)
-
-    smooth_trajectory = smooth(trajectory)
-    # Calculate difference in smoothed_trajectory and trajectory
-    difference = smooth_trajectory - trajectory
+        return np.array([m[0, 2], m[1, 2], np.arctan2(m[1, 0], m[0, 0])])
 
-    # Calculate newer transformation array
-    transforms_smooth = transforms + difference
-
-    # Reset stream to first frame
-    video.set(cv2.CAP_PROP_POS_FRAMES, 0)
-
-    # Write n_frames-1 transformed frames
-    for i in range(n_frames - 2):
+    frame_num = 0
+    while True:
         # Read next frame
-        success, frame = video.read()
-        if not success:
+        flag, curr = video.read()
+        if not flag:
             break
-        # Extract transformations from the new transformation array
-        dx, dy, da = transforms_smooth[i]
-
-        # Reconstruct transformation matrix accordingly to new values
-        m = np.array([[np.cos(da), -np.sin(da), dx], [np.sin(da), np.cos(da), dy]])
 
-        # Apply affine warping to the given frame
-        frame_stabilized = cv2.warpAffine(frame, m, (width, height))
+        if transforms is not None:
+            # Global motion handed over by the coarse stage
+            if frame_num >= len(transforms):
+                break
+            transform = np.asarray(transforms[frame_num], dtype=np.float64)
+            curr_gray = None
+        else:
+            # Convert to grayscale
+            curr_gray = cv2.cvtColor(curr, cv2.COLOR_BGR2GRAY)
+            transform = estimate_transform(prev_gray, curr_gray)
+        frame_num += 1
+
+        # Extend the trajectory and smooth it with radius frames of lookahead
+        trajectory = trajectory + transform
+        pending.append((prev, transform, trajectory))
+        smooth_trajectory = smoother.push(trajectory)
+        if smooth_trajectory is not None:
+            write_frame(smooth_trajectory)
 
-        # Fix border artifacts
-        frame_stabilized = fixBorder(frame_stabilized)
+        # Move to next frame
+        prev, prev_gray = curr, curr_gray
 
-        # Write the frame to the file
-        frame_out = cv2.vconcat([frame, frame_stabilized])
+    # Frames within radius of the end, the trajectory is padded with its last value
+    for smooth_trajectory in smoother.flush():
+        write_frame(smooth_trajectory)
 
-        cv2.imwrite(output_dir + str(i).zfill(5) + ".png", frame_out)
+    video.release()
@@ -2,10 +2,18 @@ import argparse
 import time
 
 import cv2
+import numpy as np
 
-from coarse_stab import generate_stabilized_video, get_frame_warp, read_video, stabilize
+from coarse_stab import feature_params, feature_tracker, flow_params, frame_transforms, generate_stabilized_video, get_frame_warp, read_video, stabilize, stream_stabilized_video
+from debug_artifacts import DebugArtifactWriter
+from motion_cache import MotionCache, cache_key
+from motion_store import motion_storage
 from fine_stab import fine_stab
-from utils import ffmpeg_video, mkdir_if_not_exist, plot_vertex_motion
+from metrics import metrics_stream, video_frames
+from output_sink import make_sink, sink_frames
+from parallel import segment_stabilized_video
+import profiling
+from utils import mkdir_if_not_exist
 
 
 def get_parser():
@@ -16,6 +24,24 @@ def get_parser():
     parser.add_argument('--patch_size', default=16, type=int, help='block of size in patch')
     parser.add_argument('--propagation_radius', default=300, type=int, help='motion propogation radius')
     parser.add_argument('--border', default=20, type=int, help='')
+    parser.add_argument('--sink', default='video', choices=['video', 'ffmpeg', 'npy', 'png'], help='output of stabilized frames: encoded coarse_stab.avi via cv2.VideoWriter or an ffmpeg pipe, raw coarse_stab.npy or numbered png frames')
+    parser.add_argument('--debug_artifacts', action='store_true', help='save motion vector frames and vertex path plots')
+    parser.add_argument('--debug_workers', default=2, type=int, help='background threads rendering debug artifacts')
+    parser.add_argument('--stream', action='store_true', help='single pass online stabilization with bounded memory, always uses the online optimizer')
+    parser.add_argument('--segments', default=0, type=int, help='stabilize the video as this many overlapping segments in separate processes')
+    parser.add_argument('--segment_overlap', default=50, type=int, help='frames each segment shares with its neighbours for blending')
+    parser.add_argument('--workers', default=1, type=int, help='number of worker processes for --segments, otherwise motion estimation processes and frame warping threads')
+    parser.add_argument('--persistent_tracks', action='store_true', help='carry KLT tracks across frames and only detect new corners when they run low, motion estimation then runs sequentially')
+    parser.add_argument('--cache_dir', default='', type=str, help='cache read_video results here and skip it on matching runs')
+    parser.add_argument('--cache_size', default=10, type=float, help='cache size limit in GB, least recently used entries are evicted')
+    parser.add_argument('--ram_budget', default=0, type=float, help='RAM in GB for the motion arrays of the batch pipeline, larger videos keep them memory-mapped in output_dir/scratch/, 0 for no limit')
+    parser.add_argument('--precision', default='float64', choices=['float64', 'float32'], help='dtype of motion patches, paths and optimizer state, float32 halves their memory')
+    parser.add_argument('--export_transforms', action='store_true', help='save the residual global motion of coarse_stab frames to coarse_transforms.npy for fine_stab')
+    parser.add_argument('--metrics', action='store_true', help='score the stabilized video against the input (cropping ratio, distortion, stability) once it is written')
+    parser.add_argument('--metrics_backend', default='sift', choices=['sift', 'orb', 'orb_flann'], help='features of --metrics, orb is faster for quick runs')
+    parser.add_argument('--profile_dir', default='', type=str, help='record nested stage and per-frame spans and counters, saved to profile.json and a Chrome trace.json here; with --workers > 1 the motion estimation of worker processes is not recorded')
+    parser.add_argument('--profiler', default='', choices=['', 'cprofile', 'pyinstrument'], help='also run a function level profiler, saved to --profile_dir')
+    parser.add_argument('--optimizer', default='online', choices=['online', 'offline', 'banded'], help='path optimizer, banded solves the offline objective exactly')
 
     return parser
 
@@ -24,6 +50,31 @@ if __name__ == '__main__':
 
     parser = get_parser()
     args = parser.parse_args()
+    if args.segments > 0:
+        # segments read, stabilize and warp in their own processes, without these options
+        unsupported = [name for name, value in (('--stream', args.stream), ('--debug_artifacts', args.debug_artifacts),
+                                                ('--persistent_tracks', args.persistent_tracks), ('--cache_dir', args.cache_dir),
+                                                ('--ram_budget', args.ram_budget), ('--export_transforms', args.export_transforms)) if value]
+        if unsupported:
+            parser.error('--segments does not support ' + ', '.join(unsupported))
+    if args.stream:
+        # the stream keeps a bounded window of the video in memory and runs the online optimizer in one process
+        unsupported = [name for name, value in (('--cache_dir', args.cache_dir), ('--ram_budget', args.ram_budget),
+                                                ('--optimizer ' + args.optimizer, args.optimizer != 'online'),
+                                                ('--workers', args.workers > 1)) if value]
+        if unsupported:
+            parser.error('--stream does not support ' + ', '.join(unsupported))
+    if args.stream and args.export_transforms:
+        # the transforms need the updated mesh warps of the whole video, see frame_transforms
+        parser.error('--export_transforms needs the batch pipeline, it does not support --stream')
+
+    profile_dir = args.profile_dir
+    profiler = None
+    if profile_dir:
+        mkdir_if_not_exist(profile_dir)
+        profiling.enable()
+        if args.profiler:
+            profiler = profiling.start_profiler(args.profiler)
 
     start_time = time.time()
 
@@ -32,39 +83,111 @@ if __name__ == '__main__':
     border = args.border
     patch_size = args.patch_size
     propagation_radius = args.propagation_radius
+    optimizer = args.optimizer
+    dtype = np.dtype(args.precision)
+    stream = args.stream
+    sink_kind = args.sink
+    debug_artifacts = args.debug_artifacts
+    segments = args.segments
+    workers = args.workers
+    tracker = feature_tracker() if args.persistent_tracks else None
     x_motion_vector_path = output_dir + 'x_motion_vector_path/'
     new_x_motion_vector_path = output_dir + 'new_x_motion_vector_path/'
     motion_save_path = output_dir + 'path/'
     fine_stab_path = output_dir + 'fine_stab/'
     
     mkdir_if_not_exist(output_dir)
-    mkdir_if_not_exist(x_motion_vector_path)
-    mkdir_if_not_exist(new_x_motion_vector_path)
-    mkdir_if_not_exist(motion_save_path)
     mkdir_if_not_exist(fine_stab_path)
 
-    video = cv2.VideoCapture(input_video)
-    # propogate motion vectors and generate vertex motion paths
-    print("read video...")
-    x_motion_patches, y_motion_patches, x_paths, y_paths = read_video(video, patch_size)
-
-    # stabilize the vertex profiles
-    print("stabilize...")
-    opt_x_paths, opt_y_paths = stabilize(x_paths, y_paths)
-
-    # visualize optimized paths
-    print("plot vertex motion...")
-    plot_vertex_motion(opt_x_paths, opt_y_paths, motion_save_path)
+    debug = None
+    if debug_artifacts:
+        mkdir_if_not_exist(x_motion_vector_path)
+        mkdir_if_not_exist(new_x_motion_vector_path)
+        mkdir_if_not_exist(motion_save_path)
+        debug = DebugArtifactWriter(args.debug_workers)
 
-    # get updated mesh warps
-    print("get frame warp...")
-    x_motion_patches, y_motion_patches, new_x_motion_patches, new_y_motion_patches = get_frame_warp(x_motion_patches, y_motion_patches, x_paths, y_paths, opt_x_paths, opt_y_paths)
-
-    # apply updated mesh warps & save the result
-    print("generate stabilized video...")
-    generate_stabilized_video(video, x_motion_patches, y_motion_patches, new_x_motion_patches, new_y_motion_patches, x_motion_vector_path, new_x_motion_vector_path, patch_size, border, output_dir)
+    video = cv2.VideoCapture(input_video)
+    fps = video.get(cv2.CAP_PROP_FPS) or 25
+    sink = make_sink(sink_kind, output_dir, fps)
+    if segments > 0:
+        # read, stabilize and warp overlapping segments in parallel
+        print("segment stabilized video...")
+        video.release()
+        segment_stabilized_video(input_video, patch_size, border, sink, output_dir + 'segments/', segments, args.segment_overlap, workers, optimizer, dtype, propagation_radius)
+    elif stream:
+        # propagate, optimize and warp every frame in a single pass
+        print("stream stabilized video...")
+        stream_stabilized_video(video, patch_size, border, x_motion_vector_path, new_x_motion_vector_path, sink, debug=debug, tracker=tracker, dtype=dtype, propagation_radius=propagation_radius)
+    else:
+        # keep the motion arrays on disk when they don't fit in the RAM budget
+        storage = motion_storage(int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)) // patch_size, int(video.get(cv2.CAP_PROP_FRAME_WIDTH)) // patch_size,
+                                 int(video.get(cv2.CAP_PROP_FRAME_COUNT)), int(args.ram_budget * 1024**3), output_dir + 'scratch/', dtype)
+        if storage is not None:
+            print("motion arrays exceed the RAM budget, memory-mapping them in " + storage.scratch_dir)
+
+        # propogate motion vectors and generate vertex motion paths, from the cache when possible
+        motion, cache = None, None
+        if args.cache_dir:
+            cache = MotionCache(args.cache_dir, int(args.cache_size * 1024**3))
+            key = cache_key(input_video, patch_size=patch_size, propagation_radius=propagation_radius, feature_params=feature_params,
+                            flow_params=flow_params, persistent_tracks=tracker is not None, precision=dtype.name)
+            motion = cache.load(key, storage)
+        if motion is None:
+            print("read video...")
+            checkpoint = cache.checkpoint(key) if cache is not None else None
+            motion = read_video(video, patch_size, workers=1 if tracker is not None else workers, tracker=tracker, checkpoint=checkpoint, storage=storage, dtype=dtype, propagation_radius=propagation_radius)
+            if cache is not None:
+                cache.save(key, motion)
+                checkpoint.clear()
+        else:
+            print("read video from cache...")
+
+        # stabilize the vertex profiles
+        print("stabilize...")
+        opt_x_paths, opt_y_paths = stabilize(motion.x_paths, motion.y_paths, optimizer, storage)
+
+        # visualize optimized paths
+        if debug is not None:
+            print("plot vertex motion...")
+            debug.plot_vertex_motion(opt_x_paths, opt_y_paths, motion_save_path)
+
+        # get updated mesh warps
+        print("get frame warp...")
+        x_motion_patches, y_motion_patches, new_x_motion_patches, new_y_motion_patches = get_frame_warp(motion, opt_x_paths, opt_y_paths, storage)
+
+        # residual global motion of the stabilized frames, handed to fine_stab
+        if args.export_transforms:
+            if np.isfinite(motion.homographies).all():
+                print("export frame transforms...")
+                frame_size = (int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(video.get(cv2.CAP_PROP_FRAME_WIDTH)))
+                np.save(output_dir + 'coarse_transforms.npy', frame_transforms(motion, new_x_motion_patches, new_y_motion_patches, patch_size, border, frame_size))
+            else:
+                print("no homographies in the cached motion, frame transforms are not exported")
+
+        # apply updated mesh warps & save the result
+        print("generate stabilized video...")
+        generate_stabilized_video(video, x_motion_patches, y_motion_patches, new_x_motion_patches, new_y_motion_patches, x_motion_vector_path, new_x_motion_vector_path, patch_size, border, sink, debug, workers=workers)
+        if storage is not None:
+            storage.close()
+    sink.close()
+    if debug is not None:
+        debug.close()
     print('Time elapsed: ', str(time.time() - start_time))
-    # ffmpeg_video(output_dir)
+
+    if args.metrics:
+        # decode the input and the written output in lockstep
+        print("metrics...")
+        # the segments write png frames themselves, one per input frame, bypassing sink
+        frame_count = None if segments > 0 and sink_kind == 'png' else sink.frame_num
+        metrics_stream(video_frames(input_video), sink_frames(sink_kind, output_dir, frame_count=frame_count), args.metrics_backend)
+
+    if profile_dir:
+        if profiler is not None:
+            profiling.stop_profiler(profiler, args.profiler, profile_dir)
+        profiling.save(profile_dir)
+        profiling.print_summary()
     
-    # fine_stab_video = 'coarse_stab.avi'
-    # fine_stab(fine_stab_video, fine_stab_path)
+    # fine_stab_video = output_dir + 'coarse_stab.avi'
+    # transforms = np.load(output_dir + 'coarse_transforms.npy') if args.export_transforms else None
+    # with make_sink(sink_kind, fine_stab_path, fps, 'fine_stab') as fine_stab_sink:
+    #     fine_stab(fine_stab_video, fine_stab_sink, transforms=transforms)
@@ -1,106 +1,165 @@
 # Based on: https://github.com/jinsc37/DIFRINT/blob/master/metrics.py
 
+import multiprocessing
 import os
 import sys
 import numpy as np
 import cv2
 
-def metrics(original_dir, pred_dir):
-	image_paths = sorted([path for path in os.listdir(pred_dir) if path.endswith(".png")])
+# Apply the homography transformation if we have enough good matches 
+MIN_MATCH_COUNT = 10 
 
-	# Create brute-force matcher object
-	bf = cv2.BFMatcher()
+ratio = 0.7 
+thresh = 5.0 
 
-	sift = cv2.SIFT_create()
+# Detector / matcher per process, cv2 objects can't be sent to workers
+_backends = {}
 
-	# Apply the homography transformation if we have enough good matches 
-	MIN_MATCH_COUNT = 10 
+def feature_backend(backend='sift'):
+	"""
+	Input:
+	backend: 'sift' (SIFT + brute-force matcher, the reference metrics), or for quick regression runs 'orb' (ORB + brute-force
+		Hamming matcher) or 'orb_flann' (ORB + FLANN LSH, which only pays off with many more features per frame)
 
-	ratio = 0.7 
-	thresh = 5.0 
+	Output:
+	detector, matcher
+	"""
+	if backend not in _backends:
+		if backend == 'sift':
+			_backends[backend] = (cv2.SIFT_create(), cv2.BFMatcher())
+		elif backend == 'orb':
+			_backends[backend] = (cv2.ORB_create(nfeatures=1000), cv2.BFMatcher(cv2.NORM_HAMMING))
+		elif backend == 'orb_flann':
+			index_params = dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1)  # FLANN_INDEX_LSH
+			_backends[backend] = (cv2.ORB_create(nfeatures=1000), cv2.FlannBasedMatcher(index_params, dict(checks=50)))
+		else:
+			raise ValueError('Unknown feature backend: ' + backend)
+	return _backends[backend]
 
-	CR_seq = []
-	DV_seq = []
-	Pt = np.eye(3)
-	P_seq = []
+def frame_features(img, backend='sift'):
+	"""
+	Input:
+	img: gray scale frame
 
-	for i in range(len(image_paths)):
-		# Load the images in gray scale
-		img1 = cv2.imread(original_dir + image_paths[i], 0)
-		img1o = cv2.imread(pred_dir + image_paths[i], 0)
+	Output:
+	points: N*2 float32 key point positions
+	descriptors: their descriptors, None without key points
+	"""
+	detector, _ = feature_backend(backend)
+	keyPoints, descriptors = detector.detectAndCompute(img, None)
+	return np.float32([kp.pt for kp in keyPoints]).reshape(-1, 2), descriptors
 
-		# Detect the SIFT key points and compute the descriptors for the two images
-		keyPoints1, descriptors1 = sift.detectAndCompute(img1, None)
-		keyPoints1o, descriptors1o = sift.detectAndCompute(img1o, None)
+def match_homography(features1, features2, backend='sift'):
+	"""
+	Input:
+	features1, features2: frame_features of two frames
 
-		# Match the descriptors
-		matches = bf.knnMatch(descriptors1, descriptors1o, k=2)
+	Output:
+	M: homography from the first frame to the second, None without enough good matches
+	"""
+	points1, descriptors1 = features1
+	points2, descriptors2 = features2
+	if descriptors1 is None or descriptors2 is None or len(descriptors2) < 2:
+		return None
 
-		# Select the good matches using the ratio test
-		goodMatches = []
+	# Match the descriptors
+	_, matcher = feature_backend(backend)
+	matches = matcher.knnMatch(descriptors1, descriptors2, k=2)
 
-		for m, n in matches:
-			if m.distance < ratio * n.distance:
-				goodMatches.append(m)
+	# Select the good matches using the ratio test
+	goodMatches = [pair[0] for pair in matches if len(pair) == 2 and pair[0].distance < ratio * pair[1].distance]
 
-		if len(goodMatches) > MIN_MATCH_COUNT:
-			# Get the good key points positions
-			sourcePoints = np.float32([ keyPoints1[m.queryIdx].pt for m in goodMatches ]).reshape(-1, 1, 2)
-			destinationPoints = np.float32([ keyPoints1o[m.trainIdx].pt for m in goodMatches ]).reshape(-1, 1, 2)
-			
-			# Obtain the homography matrix
-			M, _ = cv2.findHomography(sourcePoints, destinationPoints, method=cv2.RANSAC, ransacReprojThreshold=thresh)
+	if len(goodMatches) <= MIN_MATCH_COUNT:
+		return None
 
+	# Get the good key points positions
+	sourcePoints = points1[[m.queryIdx for m in goodMatches]].reshape(-1, 1, 2)
+	destinationPoints = points2[[m.trainIdx for m in goodMatches]].reshape(-1, 1, 2)
 
-		# Obtain Scale, Translation, Rotation, Distortion value
+	# Obtain the homography matrix
+	M, _ = cv2.findHomography(sourcePoints, destinationPoints, method=cv2.RANSAC, ransacReprojThreshold=thresh)
+	return M
 
-		# Based on https://math.stackexchange.com/questions/78137/decomposition-of-a-nonsquare-affine-matrix
-		scaleRecovered = np.sqrt(M[0,1]**2 + M[0,0]**2)
+class MetricsAccumulator(object):
+	"""
+	Per-frame part of the metrics: cropping ratio and distortion of every (original, predicted) frame pair and the
+	homography between consecutive predicted frames. Every frame is detected once, the features of the last
+	predicted frame are carried over to the next stability step.
+
+	When a frame has too few good matches, the last homography of the same step is reused (identity at first).
+	"""
 
-		w, _ = np.linalg.eig(M[0:2, 0:2])
-		# w, _ = np.linalg.eig(M[0:2])
-		w = np.sort(w)[::-1]
-		DV = w[1]/w[0]
+	def __init__(self, backend='sift'):
+		self.backend = backend
+		self.CR_seq = []
+		self.DV_seq = []
+		self.M_seq = []  # homographies between consecutive predicted frames
+		self.M_crop = np.eye(3)
+		self.M_pair = np.eye(3)
+		self.prev_features = None
 
-		CR_seq.append(1/scaleRecovered)
-		DV_seq.append(DV)
+	def add(self, pred, original=None):
+		"""
+		Input:
+		pred: gray scale predicted frame
+		original: the gray scale original frame, None to only use pred for the stability step
+		"""
+		pred_features = frame_features(pred, self.backend)
+
+		if original is not None:
+			M = match_homography(frame_features(original, self.backend), pred_features, self.backend)
+			if M is not None:
+				self.M_crop = M
+			CR, DV = crop_distortion(self.M_crop)
+			self.CR_seq.append(CR)
+			self.DV_seq.append(DV)
 
 		# For Stability score calculation
-		if i+1 < len(image_paths):
-			
-			img2o = cv2.imread(pred_dir + image_paths[i+1], 0)
-
-			keyPoints2o, descriptors2o = sift.detectAndCompute(img2o, None)
-			matches = bf.knnMatch(descriptors1o, descriptors2o, k=2)
-			goodMatches = []
-
-			for m, n in matches:
-				if m.distance < ratio * n.distance:
-					goodMatches.append(m)
-
-			if len(goodMatches) > MIN_MATCH_COUNT:
-				# Get the good key points positions
-				sourcePoints = np.float32([ keyPoints1o[m.queryIdx].pt for m in goodMatches ]).reshape(-1, 1, 2)
-				destinationPoints = np.float32([ keyPoints2o[m.trainIdx].pt for m in goodMatches ]).reshape(-1, 1, 2)
-				
-				# Obtain the homography matrix
-				M, _ = cv2.findHomography(sourcePoints, destinationPoints, method=cv2.RANSAC, ransacReprojThreshold=thresh)
-				# print(M)
-				# M, _ = cv2.estimateAffine2D(sourcePoints, destinationPoints, method=cv2.RANSAC, ransacReprojThreshold=thresh)
-			#end
-
-			P_seq.append(np.matmul(Pt, M))
-			Pt = np.matmul(Pt, M)
-		sys.stdout.write('\rFrame: ' + str(i) + '/' + str(len(image_paths)))
-		sys.stdout.flush()
-		#end
-	#end
+		if self.prev_features is not None:
+			M = match_homography(self.prev_features, pred_features, self.backend)
+			if M is not None:
+				self.M_pair = M
+			self.M_seq.append(self.M_pair)
+		self.prev_features = pred_features
+
+def crop_distortion(M):
+	"""
+	Input:
+	M: homography from an original frame to its predicted frame
+
+	Output:
+	CR, DV: cropping ratio and distortion value
+	"""
+	# Obtain Scale, Translation, Rotation, Distortion value
+
+	# Based on https://math.stackexchange.com/questions/78137/decomposition-of-a-nonsquare-affine-matrix
+	scaleRecovered = np.sqrt(M[0,1]**2 + M[0,0]**2)
+
+	w, _ = np.linalg.eig(M[0:2, 0:2])
+	# w, _ = np.linalg.eig(M[0:2])
+	w = np.sort(w)[::-1]
+	DV = w[1]/w[0]
+
+	return 1/scaleRecovered, DV
+
+def stability_score(M_seq):
+	"""
+	Input:
+	M_seq: homographies between consecutive predicted frames
+
+	Output:
+	SS_t, SS_r: stability score of translation and rotation
+	"""
+	P_seq = []
+	Pt = np.eye(3)
+	for M in M_seq:
+		Pt = np.matmul(Pt, M)
+		P_seq.append(Pt)
 
 	# Make 1D temporal signals
 	P_seq_t = []
 	P_seq_r = []
 	
-	#pdb.set_trace()
 	for Mp in P_seq:
 		transRecovered = np.sqrt(Mp[0, 2]**2 + Mp[1, 2]**2)
 		# Based on https://math.stackexchange.com/questions/78137/decomposition-of-a-nonsquare-affine-matrix
@@ -124,14 +183,144 @@ def metrics(original_dir, pred_dir):
 	SS_t = np.sum(fft_t[:5])/np.sum(fft_t)
 	SS_r = np.sum(fft_r[:5])/np.sum(fft_r)
 
+	return SS_t, SS_r
+
+def summarize(CR_seq, DV_seq, M_seq):
+	"""
+	Output:
+	results: dict of cropping ratio (avg, min), distortion value and stability score (avg, trans, rot)
+	"""
+	SS_t, SS_r = stability_score(M_seq)
+	return {
+		'cropping_ratio': np.min([np.mean(CR_seq), 1]),
+		'cropping_ratio_min': np.min([np.min(CR_seq), 1]),
+		'distortion': np.absolute(np.min(DV_seq)),
+		'stability': (SS_t+SS_r)/2,
+		'stability_t': SS_t,
+		'stability_r': SS_r,
+	}
+
+def print_metrics(results):
 	print('\n')
 	print('***Cropping ratio (Avg, Min):')
-	print( str.format('{0:.4f}', np.min([np.mean(CR_seq), 1])) +' | '+ str.format('{0:.4f}', np.min([np.min(CR_seq), 1])) )
+	print( str.format('{0:.4f}', results['cropping_ratio']) +' | '+ str.format('{0:.4f}', results['cropping_ratio_min']) )
 	print('***Distortion value:')
-	print(str.format('{0:.4f}', np.absolute(np.min(DV_seq))) )
+	print(str.format('{0:.4f}', results['distortion']) )
 	print('***Stability Score (Avg, Trans, Rot):')
-	print(str.format('{0:.4f}',  (SS_t+SS_r)/2) +' | '+ str.format('{0:.4f}', SS_t) +' | '+ str.format('{0:.4f}', SS_r) )
+	print(str.format('{0:.4f}', results['stability']) +' | '+ str.format('{0:.4f}', results['stability_t']) +' | '+ str.format('{0:.4f}', results['stability_r']) )
+
+def _metrics_chunk(job):
+	original_dir, pred_dir, image_paths, start, end, backend = job
+	cv2.setNumThreads(1)
+
+	accumulator = MetricsAccumulator(backend)
+	# Frames [start, end), plus the first frame of the next chunk for the last stability step
+	for i in range(start, min(end + 1, len(image_paths))):
+		# Load the images in gray scale
+		img1o = cv2.imread(pred_dir + image_paths[i], 0)
+		img1 = cv2.imread(original_dir + image_paths[i], 0) if i < end else None
+		accumulator.add(img1o, img1)
+
+	return accumulator.CR_seq, accumulator.DV_seq, accumulator.M_seq
+
+def metrics(original_dir, pred_dir, workers=1, backend='sift', chunk_size=64):
+	"""
+	Input:
+	original_dir, pred_dir: directories of the numbered png frames of the original and predicted video
+	workers: processes scoring chunks of chunk_size consecutive frames
+	backend: feature backend, see feature_backend
+
+	Output:
+	results: see summarize, also printed
+	"""
+	image_paths = sorted([path for path in os.listdir(pred_dir) if path.endswith(".png")])
+
+	jobs = [(original_dir, pred_dir, image_paths, start, min(start + chunk_size, len(image_paths)), backend)
+			for start in range(0, len(image_paths), chunk_size)]
+
+	CR_seq = []
+	DV_seq = []
+	M_seq = []
+
+	if workers > 1:
+		# spawn, so that workers don't inherit the parent's OpenCV thread pool
+		pool = multiprocessing.get_context('spawn').Pool(workers)
+		chunks = pool.imap(_metrics_chunk, jobs)
+	else:
+		pool = None
+		chunks = map(_metrics_chunk, jobs)
+
+	for job, (CR_chunk, DV_chunk, M_chunk) in zip(jobs, chunks):
+		CR_seq.extend(CR_chunk)
+		DV_seq.extend(DV_chunk)
+		M_seq.extend(M_chunk)
+		sys.stdout.write('\rFrame: ' + str(job[4]) + '/' + str(len(image_paths)))
+		sys.stdout.flush()
+	#end
+
+	if pool is not None:
+		pool.close()
+		pool.join()
+
+	results = summarize(CR_seq, DV_seq, M_seq)
+	print_metrics(results)
+
+	return results
+
+def video_frames(video):
+	"""
+	Input:
+	video: path of a video
+
+	Output:
+	frames: generator of its gray scale frames, decoded one at a time
+	"""
+	capture = cv2.VideoCapture(video)
+	try:
+		while True:
+			flag, frame = capture.read()
+			if not flag:
+				break
+			yield cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+	finally:
+		capture.release()
+
+def metrics_stream(original_frames, pred_frames, backend='sift'):
+	"""
+	Metrics computed on the fly from frames of the original and predicted video taken in lockstep, holding
+	only the current frames and the carried over features; stops at the end of the shorter sequence.
+
+	Input:
+	original_frames, pred_frames: iterables of gray scale or BGR frames, e.g. video_frames
+	backend: feature backend, see feature_backend
+
+	Output:
+	results: see summarize, also printed
+	"""
+	accumulator = MetricsAccumulator(backend)
+
+	for i, (img1, img1o) in enumerate(zip(original_frames, pred_frames)):
+		if img1.ndim == 3:
+			img1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
+		if img1o.ndim == 3:
+			img1o = cv2.cvtColor(img1o, cv2.COLOR_BGR2GRAY)
+		accumulator.add(img1o, img1)
+		sys.stdout.write('\rFrame: ' + str(i))
+		sys.stdout.flush()
+	#end
+	if len(accumulator.M_seq) == 0:
+		# the stability score needs at least one step between predicted frames
+		raise ValueError('metrics_stream needs at least two frames of both videos, got ' + str(len(accumulator.CR_seq)))
+
+	results = summarize(accumulator.CR_seq, accumulator.DV_seq, accumulator.M_seq)
+	print_metrics(results)
+
+	return results
+
+def video_metrics(original_video, pred_video, backend='sift'):
+	""" metrics_stream of two video files, decoded in lockstep """
+	return metrics_stream(video_frames(original_video), video_frames(pred_video), backend)
 
 if __name__ == '__main__':
 	metrics(original_dir='/GPFS/data/haoningwu/EE229/data/Regular/3/', pred_dir='/GPFS/data/haoningwu/EE229/test/pr_3/')
-	metrics(original_dir='/GPFS/data/haoningwu/EE229/data/Regular/5/', pred_dir='/GPFS/data/haoningwu/EE229/test/pr_5/')
\ No newline at end of file
+	metrics(original_dir='/GPFS/data/haoningwu/EE229/data/Regular/5/', pred_dir='/GPFS/data/haoningwu/EE229/test/pr_5/')
@@ -0,0 +1,131 @@
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from motion_store import MotionStore
+from utils import mkdir_if_not_exist
+
+
+def cache_key(input_video, **params):
+    """
+    Input:
+    input_video: path of the video
+    params: parameters the motion estimation depends on (patch size, feature/flow/propagation parameters, ...)
+
+    Output:
+    key: sha1 hex digest of the video content and the parameters
+    """
+
+    sha1 = hashlib.sha1()
+    with open(input_video, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    sha1.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+
+    return sha1.hexdigest()
+
+
+class MotionCheckpoint(object):
+    """
+    Periodic checkpoint of a MotionStore being filled by read_video, so that an interrupted run resumes
+    from the last saved frame instead of starting over. Every update appends the frames since the last
+    one as a chunk file in the checkpoint directory, so checkpoint I/O stays linear in the video length;
+    load merges the chunks.
+    """
+
+    def __init__(self, path, interval=500):
+        self.path = path
+        self.interval = interval
+        self.saved_length = 0
+
+    def _chunks(self):
+        # chunk_<first frame>.npz, in frame order
+        paths = glob.glob(os.path.join(self.path, 'chunk_*.npz'))
+        return sorted((int(os.path.basename(p)[6:-4]), p) for p in paths)
+
+    def load(self, capacity=None, storage=None):
+        motion = None
+        for start, path in self._chunks():
+            length = motion.length if motion is not None else 0
+            if start != length:
+                # a gap, e.g. after a failed write; the later chunks are recomputed
+                break
+            with np.load(path) as data:
+                x_motion_patches, y_motion_patches = data['x_motion_patches'], data['y_motion_patches']
+                homographies = data['homographies']
+            if motion is None:
+                rows, cols, _ = x_motion_patches.shape
+                motion = MotionStore(rows, cols, capacity or x_motion_patches.shape[2], x_motion_patches.dtype, storage)
+            for t in range(x_motion_patches.shape[2]):
+                motion.append(x_motion_patches[:, :, t], y_motion_patches[:, :, t], update_paths=False, homography=homographies[t])
+        if motion is None:
+            return None
+        motion.build_paths()
+        self.saved_length = motion.length
+        return motion
+
+    def update(self, motion):
+        if motion.length - self.saved_length >= self.interval:
+            start, end = self.saved_length, motion.length
+            mkdir_if_not_exist(self.path)
+            path = os.path.join(self.path, 'chunk_%08d.npz' % start)
+            tmp_path = os.path.join(self.path, 'tmp_%08d.npz' % start)
+            # write then rename, so that a crash never leaves a truncated chunk
+            np.savez(tmp_path, x_motion_patches=motion.x_motion_patches[:, :, start:end],
+                     y_motion_patches=motion.y_motion_patches[:, :, start:end], homographies=motion.homographies[start:end])
+            os.replace(tmp_path, path)
+            self.saved_length = end
+
+    def clear(self):
+        if os.path.isdir(self.path):
+            for path in glob.glob(os.path.join(self.path, '*.npz')):
+                os.remove(path)
+            os.rmdir(self.path)
+        self.saved_length = 0
+
+
+class MotionCache(object):
+    """
+    On-disk cache of read_video results: one .npz of motion patches per key, paths are rebuilt on load.
+    Least recently used entries are evicted once the cache grows over max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        mkdir_if_not_exist(cache_dir)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def load(self, key, storage=None):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)  # mark as recently used
+        return MotionStore.load(path, storage=storage)
+
+    def save(self, key, motion):
+        path = self._path(key)
+        motion.save(path + '.tmp.npz')
+        os.replace(path + '.tmp.npz', path)
+        self.evict(keep=path)
+
+    def checkpoint(self, key, interval=500):
+        return MotionCheckpoint(os.path.join(self.cache_dir, key + '.partial'), interval)
+
+    def evict(self, keep=None):
+        entries = [path for path in glob.glob(os.path.join(self.cache_dir, '*.npz'))
+                   if not path.endswith('.tmp.npz')]
+        entries.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in entries)
+        for path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            total -= os.path.getsize(path)
+            os.remove(path)
@@ -0,0 +1,244 @@
+import os
+
+import numpy as np
+
+from utils import mkdir_if_not_exist
+
+
+# (rows, cols, time) arrays held by the batch pipeline at once: motion patches, paths, optimized paths and
+# new motion patches, in x and y
+PIPELINE_ARRAYS = 8
+
+
+class ArrayStorage(object):
+    """
+    In-memory storage of (rows, cols, time) arrays, the default of MotionStore and the batch pipeline.
+    """
+
+    def empty(self, shape, dtype=np.float64, vertex_major=None):
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, array):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemmapStorage(ArrayStorage):
+    """
+    Out-of-core storage: every array is an np.memmap file in scratch_dir, paged in and out by the OS.
+
+    (rows, cols, time) arrays are laid out time-major on disk by default, i.e. a (time, rows, cols) file
+    exposed through a transposed view, since appending motion patches, the online optimizer and the
+    frame warping all touch one time step at a time. vertex_major keeps the time series of every vertex
+    contiguous instead, which suits the offline and banded optimizers working vertex by vertex; it can
+    also be chosen per array in empty, see copy_time_blocks to convert between the layouts.
+    """
+
+    def __init__(self, scratch_dir, vertex_major=False):
+        self.scratch_dir = scratch_dir
+        self.vertex_major = vertex_major
+        self.files = {}
+        self.count = 0
+        mkdir_if_not_exist(scratch_dir)
+
+    def empty(self, shape, dtype=np.float64, vertex_major=None):
+        path = os.path.join(self.scratch_dir, 'array_%04d.dat' % self.count)
+        self.count += 1
+        if vertex_major is None:
+            vertex_major = self.vertex_major
+        if len(shape) == 3 and not vertex_major:
+            array = np.moveaxis(np.memmap(path, dtype, 'w+', shape=(shape[2], shape[0], shape[1])), 0, 2)
+        else:
+            array = np.memmap(path, dtype, 'w+', shape=tuple(shape))
+        self.files[id(array)] = path
+        return array
+
+    def release(self, array):
+        # the mapping stays valid until the array is collected, only the name goes away
+        path = self.files.pop(id(array), None)
+        if path is not None:
+            os.remove(path)
+
+    def close(self):
+        for path in self.files.values():
+            os.remove(path)
+        self.files = {}
+        if not os.listdir(self.scratch_dir):
+            os.rmdir(self.scratch_dir)
+
+
+def copy_time_blocks(src, dst, block_bytes=64 * 1024**2):
+    """
+    Input:
+    src, dst: (rows, cols, time) arrays of the same shape, e.g. a time-major and a vertex-major memmap
+    block_bytes: size of the blocks of time steps copied at once
+
+    Copies src into dst in blocks of consecutive time steps, so that a time-major array is read or written
+    sequentially and a vertex-major one in runs of a whole block per vertex, instead of touching every page
+    of the time-major file once per vertex row.
+    """
+
+    rows, cols, time = src.shape
+    block = max(block_bytes // (rows * cols * src.dtype.itemsize), 1)
+    for t in range(0, time, block):
+        dst[:, :, t:t+block] = src[:, :, t:t+block]
+
+
+def motion_storage(rows, cols, frame_count, ram_budget, scratch_dir, dtype=np.float64):
+    """
+    Input:
+    rows, cols: number of mesh vertices along y and x
+    frame_count: number of frames of the video
+    ram_budget: bytes the (rows, cols, time) arrays of the batch pipeline may take in RAM, 0 for no limit
+    scratch_dir: directory of the memory-mapped arrays
+
+    Output:
+    storage: None (keep everything in RAM) when the arrays fit in ram_budget, a time-major MemmapStorage otherwise
+    """
+
+    size = PIPELINE_ARRAYS * rows * cols * (frame_count + 1) * np.dtype(dtype).itemsize
+    if ram_budget <= 0 or size <= ram_budget:
+        return None
+    return MemmapStorage(scratch_dir)
+
+
+class MotionStore(object):
+    """
+    Preallocated storage of the per-frame motion patches and vertex paths of a video.
+
+    Motion patches and paths are kept as (rows, cols, time) arrays whose time axis is
+    allocated up front (e.g. from CAP_PROP_FRAME_COUNT) and grown geometrically when the
+    frame count turns out to be wrong, so appending a frame never copies the whole history.
+    Paths are the running cumulative sum of the motion patches, starting from zero.
+    The arrays are allocated from storage, in RAM by default or memory-mapped with MemmapStorage.
+    The global homography of every frame pair is kept alongside (in RAM, NaN when unknown).
+    """
+
+    def __init__(self, rows, cols, capacity=1, dtype=np.float64, storage=None):
+        self.rows = rows
+        self.cols = cols
+        self.dtype = np.dtype(dtype)
+        self.storage = storage if storage is not None else ArrayStorage()
+        self.length = 0  # number of stored motion patches
+
+        capacity = max(int(capacity), 1)
+        # one spare slot for the padded last frame of frame_warp_patches
+        self._x_motion = self._allocate(capacity + 1)
+        self._y_motion = self._allocate(capacity + 1)
+        self._x_paths = self._allocate(capacity + 1)
+        self._y_paths = self._allocate(capacity + 1)
+        self._x_paths[:, :, 0] = 0
+        self._y_paths[:, :, 0] = 0
+        self._homographies = np.full((capacity + 1, 3, 3), np.nan)
+
+    def _allocate(self, capacity):
+        return self.storage.empty((self.rows, self.cols, capacity), self.dtype)
+
+    @property
+    def capacity(self):
+        return self._x_motion.shape[2] - 1
+
+    def _grow(self, capacity):
+        for name in ('_x_motion', '_y_motion', '_x_paths', '_y_paths'):
+            old = getattr(self, name)
+            new = self._allocate(capacity + 1)
+            new[:, :, :self.length + 1] = old[:, :, :self.length + 1]
+            setattr(self, name, new)
+            self.storage.release(old)
+        homographies = np.full((capacity + 1, 3, 3), np.nan)
+        homographies[:self.length] = self._homographies[:self.length]
+        self._homographies = homographies
+
+    def append(self, x_motion_patch, y_motion_patch, update_paths=True, homography=None):
+        """
+        Input:
+        x_motion_patch: obtained motion patch along x_direction
+        y_motion_patch: obtained motion patch along y_direction
+        update_paths: extend the paths as well; when False, call build_paths once all patches are appended
+        homography: optional global homography of the frame pair
+        """
+
+        if self.length == self.capacity:
+            self._grow(2 * self.capacity)
+
+        t = self.length
+        self._x_motion[:, :, t] = x_motion_patch
+        self._y_motion[:, :, t] = y_motion_patch
+        if homography is not None:
+            self._homographies[t] = homography
+        if update_paths:
+            np.add(self._x_paths[:, :, t], x_motion_patch, out=self._x_paths[:, :, t + 1], casting='unsafe')
+            np.add(self._y_paths[:, :, t], y_motion_patch, out=self._y_paths[:, :, t + 1], casting='unsafe')
+        self.length += 1
+
+    def build_paths(self):
+        """ Rebuild all paths from the stored motion patches with one cumulative sum. """
+
+        np.cumsum(self.x_motion_patches, axis=2, out=self._x_paths[:, :, 1:self.length + 1])
+        np.cumsum(self.y_motion_patches, axis=2, out=self._y_paths[:, :, 1:self.length + 1])
+
+    @property
+    def x_motion_patches(self):
+        return self._x_motion[:, :, :self.length]
+
+    @property
+    def y_motion_patches(self):
+        return self._y_motion[:, :, :self.length]
+
+    @property
+    def homographies(self):
+        return self._homographies[:self.length]
+
+    @property
+    def x_paths(self):
+        return self._x_paths[:, :, :self.length + 1]
+
+    @property
+    def y_paths(self):
+        return self._y_paths[:, :, :self.length + 1]
+
+    def frame_warp_patches(self):
+        """
+        Output:
+        x_motion_patches, y_motion_patches: motion patches with the last one repeated, so that there is
+        one patch per frame like the paths, written into the spare slot instead of a new array
+        """
+
+        t = self.length
+        self._x_motion[:, :, t] = self._x_motion[:, :, t - 1]
+        self._y_motion[:, :, t] = self._y_motion[:, :, t - 1]
+
+        return self._x_motion[:, :, :t + 1], self._y_motion[:, :, :t + 1]
+
+    def save(self, path):
+        """ Save the motion patches and homographies to an .npz file, paths are rebuilt on load. """
+        np.savez(path, x_motion_patches=self.x_motion_patches, y_motion_patches=self.y_motion_patches, homographies=self.homographies)
+
+    @classmethod
+    def load(cls, path, capacity=None, storage=None):
+        """
+        Input:
+        path: .npz file written by save
+        capacity: number of motion patches to allocate for, e.g. to keep appending after a resume
+        storage: storage of the arrays, in RAM by default
+
+        Output:
+        motion: MotionStore with the saved motion patches and their paths
+        """
+
+        with np.load(path) as data:
+            # one array in RAM at a time
+            x_motion_patches = data['x_motion_patches']
+            rows, cols, length = x_motion_patches.shape
+            motion = cls(rows, cols, max(length, capacity or 0), x_motion_patches.dtype, storage)
+            motion._x_motion[:, :, :length] = x_motion_patches
+            del x_motion_patches
+            motion._y_motion[:, :, :length] = data['y_motion_patches']
+            if 'homographies' in data:
+                motion._homographies[:length] = data['homographies']
+        motion.length = length
+        motion.build_paths()
+
+        return motion
@@ -1,8 +1,9 @@
 import numpy as np
 from cvxpy import *
+from scipy.linalg import solve_banded
 from tqdm import tqdm
 
-from utils import gaussian_kernel, gaussian_window
+from utils import gaussian_band, gaussian_kernel, gaussian_window
 
 def cvx_optimize_path(trajectory, window_size=6, lambda_t=1):
     """
@@ -61,8 +62,9 @@ def offline_optimize_path(trajectory, iterations=50, window_size=6, lambda_t=1):
     height, width, time = trajectory.shape
     smooth_trajectory = np.empty_like(trajectory)
 
-    window = gaussian_window(time, window_size)
-    gamma = 1 + lambda_t * np.dot(window, np.ones((trajectory.shape[2],)))
+    # iterate in the trajectory's precision
+    window = gaussian_window(time, window_size).astype(trajectory.dtype)
+    gamma = 1 + lambda_t * np.dot(window, np.ones((trajectory.shape[2],), dtype=trajectory.dtype))
 
     for i in range(height):
         for j in range(width):
@@ -75,10 +77,111 @@ def offline_optimize_path(trajectory, iterations=50, window_size=6, lambda_t=1):
     return smooth_trajectory
 
 
+def banded_optimize_path(trajectory, window_size=6, lambda_t=1):
+    """
+    Input:
+    trajectory: original camera trajectory, vertex tracks along the last axis, e.g. (height, width, time)
+    window_size: default = 6
+    lambda_t: default = 1
+
+    Output:
+    smooth_trajectory: the exact minimizer that offline_optimize_path iterates towards, i.e. the solution of
+        (I + lambda_t * (diag(window * 1) - window)) P = C
+    The system only spans the window offsets of gaussian_window (-window_size//2 to window_size//2, one
+    more frame back than ahead for odd sizes, where the system is not symmetric), so it is factorized once
+    as a banded LU and all vertex tracks are solved as right-hand sides in O(time * window_size**2). The
+    solve runs in float64, the result has the trajectory's dtype.
+    """
+
+    time = trajectory.shape[-1]
+    tracks = trajectory.reshape(-1, time)
+
+    offsets, weights = gaussian_band(window_size)
+    # the builtin min/max are shadowed by cvxpy
+    lower, upper = int(np.maximum(-offsets.min(), 0)), int(np.maximum(offsets.max(), 0))
+
+    # banded storage: ab[upper + i - k, k] = A[i, k], A = I + lambda_t * (diag(window * 1) - window)
+    ab = np.zeros((lower + upper + 1, time))
+    ab[upper, :] = 1
+    for j, w in zip(offsets, weights):
+        # rows i with window[i, i+j] inside the matrix
+        rows = np.arange(time)
+        rows = rows[(rows + j >= 0) & (rows + j < time)]
+        ab[upper - j, rows + j] = -lambda_t * w
+        ab[upper, rows] += lambda_t * w
+
+    smooth_tracks = solve_banded((lower, upper), ab, tracks.T)
+
+    return smooth_tracks.T.astype(trajectory.dtype).reshape(trajectory.shape)
+
+
+class OnlinePathOptimizer(object):
+    """
+    Streaming form of online_optimize_path: consumes one path sample per frame and returns the optimized
+    value for that frame, keeping only the last buffer_size samples of every vertex track in memory.
+    """
+
+    def __init__(self, shape, buffer_size=100, iterations=50, window_size=6, beta=1, lambda_t=1, dtype=np.float64):
+        self.shape = tuple(shape)
+        self.buffer_size = buffer_size
+        self.iterations = iterations
+        self.beta = beta
+        self.lambda_t = lambda_t
+
+        # window, buffer and iterates all share dtype, so float32 paths are optimized in float32
+        self.window = gaussian_window(buffer_size, window_size).astype(dtype)
+        self.buffer = np.empty((int(np.prod(self.shape)), buffer_size), dtype=dtype)
+        self.t = 0
+        self.d = None
+
+    def update(self, path):
+        """
+        Input:
+        path: the path sample of the current frame, of the optimizer's shape
+
+        Output:
+        opt_path: the optimized path sample of the current frame
+        """
+
+        buffer_size, beta, lambda_t = self.buffer_size, self.beta, self.lambda_t
+        self.t += 1
+        t = self.t
+
+        if t < buffer_size + 1:
+            self.buffer[:, t-1] = np.ravel(path)
+            target = self.buffer[:, :t]
+            track = np.array(target)
+            if not self.d is None:
+                window_t = self.window[:t, :t].T
+                gamma = 1 + lambda_t * np.dot(self.window[:t, :t], np.ones((t,), dtype=self.window.dtype))
+                gamma[:-1] = gamma[:-1] + beta
+                for _ in range(self.iterations):
+                    alpha = target + lambda_t * np.dot(track, window_t)
+                    alpha[:, :-1] = alpha[:, :-1] + beta * self.d
+                    track = np.divide(alpha, gamma)
+        else:
+            # slide the buffer by one frame
+            self.buffer[:, :-1] = self.buffer[:, 1:]
+            self.buffer[:, -1] = np.ravel(path)
+            target = self.buffer
+            track = np.array(target)
+            window_t = self.window.T
+            gamma = 1 + lambda_t * np.dot(self.window, np.ones((buffer_size,), dtype=self.window.dtype))
+            gamma[:-1] = gamma[:-1] + beta
+            for _ in range(self.iterations):
+                alpha = target + lambda_t * np.dot(track, window_t)
+                alpha[:, :-1] = alpha[:, :-1] + beta * self.d[:, 1:]
+                track = np.divide(alpha, gamma)
+        self.d = np.asarray(track)
+
+        return track[:, -1].reshape(self.shape)
+
+
 def online_optimize_path(trajectory, buffer_size=100, iterations=50, window_size=6, beta=1, lambda_t=1):
     """
     Input:
-    trajectory: original camera trajectory
+    trajectory: original camera trajectory, vertex tracks along the last axis, e.g. (height, width, time)
+        or (2, height, width, time) to optimize x and y paths in the same batch
     buffer_size: default = 100
     iterations: default = 50
     window_size: default = 32
@@ -88,39 +191,13 @@ def online_optimize_path(trajectory, buffer_size=100, iterations=50, window_size
     Output:
     smooth_trajectory: an optimized gaussian smooth camera trajectory 
     """
-    
-    height, width, time = trajectory.shape
+
+    time = trajectory.shape[-1]
     smooth_trajectory = np.empty_like(trajectory)
 
-    window = gaussian_window(buffer_size, window_size)
+    # online optimization, all vertex tracks at once
+    optimizer = OnlinePathOptimizer(trajectory.shape[:-1], buffer_size, iterations, window_size, beta, lambda_t, trajectory.dtype)
+    for t in tqdm(range(time)):
+        smooth_trajectory[..., t] = optimizer.update(trajectory[..., t])
 
-    bar = tqdm(height * width)
-    for i in range(height):
-        for j in range(width):
-            res = []
-            d = None
-            # online optimization
-            for t in range(1, time+1):
-                if t < buffer_size + 1:
-                    track = np.array(trajectory[i, j, :t])
-                    if not d is None:
-                        for _ in range(iterations):
-                            alpha = trajectory[i, j, :t] + lambda_t * np.dot(window[:t, :t], track)
-                            alpha[:-1] = alpha[:-1] + beta * d
-                            gamma = 1 + lambda_t * np.dot(window[:t, :t], np.ones((t,)))
-                            gamma[:-1] = gamma[:-1] + beta
-                            track = np.divide(alpha, gamma)
-                else:
-                    track = np.array(trajectory[i, j, t-buffer_size: t])
-                    for _ in range(iterations):
-                        alpha = trajectory[i, j, t-buffer_size: t] + lambda_t * np.dot(window, track)
-                        alpha[:-1] = alpha[:-1] + beta * d[1:]
-                        gamma = 1 + lambda_t * np.dot(window, np.ones((buffer_size,)))
-                        gamma[:-1] = gamma[:-1] + beta
-                        track = np.divide(alpha, gamma)
-                d = np.asarray(track)
-                res.append(track[-1])
-            smooth_trajectory[i, j, :] = np.array(res)
-            bar.update(1)
-    bar.close()
-    return smooth_trajectory
\ No newline at end of file
+    return smooth_trajectory
@@ -0,0 +1,187 @@
+import os
+import struct
+import subprocess
+
+import cv2
+import numpy as np
+
+
+class OutputSink(object):
+    """ Destination of stabilized frames, written in order with write(frame) and finished with close(). """
+
+    def write(self, frame):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PNGSink(OutputSink):
+    """ Legacy sink: every frame is written as output_dir/00000.png, 00001.png, ... starting from start. """
+
+    def __init__(self, output_dir, start=0):
+        self.output_dir = output_dir
+        self.start = start
+        self.frame_num = 0
+
+    def write(self, frame):
+        cv2.imwrite(os.path.join(self.output_dir, str(self.start + self.frame_num).zfill(5) + '.png'), frame)
+        self.frame_num += 1
+
+
+class VideoWriterSink(OutputSink):
+    """ Encodes frames directly with cv2.VideoWriter, opened on the first frame once its size is known. """
+
+    def __init__(self, path, fps=25, fourcc='MJPG'):
+        self.path = path
+        self.fps = fps
+        self.fourcc = fourcc
+        self.frame_num = 0
+        self.writer = None
+
+    def write(self, frame):
+        if self.writer is None:
+            self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, (frame.shape[1], frame.shape[0]))
+            if not self.writer.isOpened():
+                raise IOError('Cannot open video writer for ' + self.path)
+        self.writer.write(frame)
+        self.frame_num += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+
+class FFmpegSink(OutputSink):
+    """ Pipes raw BGR frames into ffmpeg, with the encoding settings of utils.ffmpeg_video. """
+
+    def __init__(self, path, fps=25, bitrate='20M'):
+        self.path = path
+        self.fps = fps
+        self.bitrate = bitrate
+        self.frame_num = 0
+        self.process = None
+
+    def write(self, frame):
+        if self.process is None:
+            cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '{}x{}'.format(frame.shape[1], frame.shape[0]), '-r', str(self.fps), '-i', '-',
+                   '-pix_fmt', 'yuv420p', '-b:v', self.bitrate, self.path]
+            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        self.process.stdin.write(np.ascontiguousarray(frame).tobytes())
+        self.frame_num += 1
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+
+
+class NpySink(OutputSink):
+    """
+    Writes uncompressed frames into a single .npy file of shape (frames, height, width, channels),
+    readable with np.load(path, mmap_mode='r'). The header is rewritten with the final frame count on close.
+    """
+
+    HEADER_LEN = 128
+
+    def __init__(self, path):
+        self.path = path
+        self.frame_num = 0
+        self.file = None
+        self.frame_shape = None
+        self.dtype = None
+
+    def _write_header(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+            np.lib.format.dtype_to_descr(self.dtype), (self.frame_num,) + self.frame_shape)
+        header = header.ljust(self.HEADER_LEN - len(np.lib.format.magic(1, 0)) - 2 - 1) + '\n'
+        self.file.seek(0)
+        self.file.write(np.lib.format.magic(1, 0))
+        self.file.write(struct.pack('<H', len(header)))
+        self.file.write(header.encode('latin1'))
+
+    def write(self, frame):
+        if self.file is None:
+            self.frame_shape, self.dtype = frame.shape, frame.dtype
+            self.file = open(self.path, 'wb')
+            self._write_header()
+        assert frame.shape == self.frame_shape, 'All frames must have the same shape.'
+        self.file.write(np.ascontiguousarray(frame, dtype=self.dtype).tobytes())
+        self.frame_num += 1
+
+    def close(self):
+        if self.file is not None:
+            self._write_header()
+            self.file.close()
+            self.file = None
+
+
+def make_sink(kind, output_dir, fps=25, name='coarse_stab'):
+    """
+    Input:
+    kind: 'png' (numbered png frames in output_dir), 'video' (cv2.VideoWriter), 'ffmpeg' (ffmpeg stdin pipe) or 'npy' (raw frames)
+    output_dir: directory of the output
+    fps: frame rate of encoded outputs
+    name: file name of the encoded output without extension
+
+    Output:
+    sink: object with write(frame) and close()
+    """
+
+    if kind == 'png':
+        return PNGSink(output_dir)
+    elif kind == 'video':
+        return VideoWriterSink(os.path.join(output_dir, name + '.avi'), fps)
+    elif kind == 'ffmpeg':
+        return FFmpegSink(os.path.join(output_dir, name + '.avi'), fps)
+    elif kind == 'npy':
+        return NpySink(os.path.join(output_dir, name + '.npy'))
+    else:
+        raise ValueError('Unknown sink: ' + kind)
+
+
+def sink_frames(kind, output_dir, name='coarse_stab', frame_count=None):
+    """
+    Input:
+    kind, output_dir, name: as given to make_sink
+    frame_count: number of frames the sink wrote (sink.frame_num), so that frames left in output_dir by an
+        earlier, longer run are not read back; png frames are otherwise read from 00000.png until one is missing
+
+    Output:
+    frames: generator reading back the frames written by the sink, one at a time
+    """
+
+    if kind == 'png':
+        frame_num = 0
+        while frame_count is None or frame_num < frame_count:
+            path = os.path.join(output_dir, str(frame_num).zfill(5) + '.png')
+            if not os.path.exists(path):
+                break
+            yield cv2.imread(path)
+            frame_num += 1
+    elif kind in ('video', 'ffmpeg'):
+        video = cv2.VideoCapture(os.path.join(output_dir, name + '.avi'))
+        try:
+            frame_num = 0
+            while frame_count is None or frame_num < frame_count:
+                flag, frame = video.read()
+                if not flag:
+                    break
+                yield frame
+                frame_num += 1
+        finally:
+            video.release()
+    elif kind == 'npy':
+        for frame in np.load(os.path.join(output_dir, name + '.npy'), mmap_mode='r')[:frame_count]:
+            yield np.array(frame)
+    else:
+        raise ValueError('Unknown sink: ' + kind)
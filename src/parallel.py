@@ -0,0 +1,151 @@
+import multiprocessing
+import os
+
+import cv2
+import numpy as np
+
+from coarse_stab import generate_stabilized_video, get_frame_warp, read_video, stabilize
+from output_sink import NpySink, PNGSink
+from utils import mkdir_if_not_exist, timer
+
+
+def segment_ranges(frame_count, segment_count, overlap):
+    """
+    Input:
+    frame_count: number of frames of the video
+    segment_count: number of temporal segments
+    overlap: frames every segment extends into each neighbour
+
+    Output:
+    segments: list of (core_start, core_end, start, end), every frame belongs to exactly one core range
+    [core_start, core_end) and is stabilized by every segment whose range [start, end) contains it
+    """
+
+    bounds = np.linspace(0, frame_count, segment_count + 1).round().astype(int)
+    segments = []
+    for k in range(segment_count):
+        core_start, core_end = int(bounds[k]), int(bounds[k+1])
+        segments.append((core_start, core_end, max(0, core_start - overlap), min(frame_count, core_end + overlap)))
+
+    return segments
+
+
+def segment_weights(segment, frame_nums):
+    """
+    Input:
+    segment: (core_start, core_end, start, end) of segment_ranges
+    frame_nums: frame indices
+
+    Output:
+    weights: blending weights of the segment, ramping linearly across the overlaps with its neighbours
+    so that the weights of two neighbouring segments sum to one
+    """
+
+    core_start, core_end, start, end = segment
+    weights = ((frame_nums >= start) & (frame_nums < end)).astype(np.float64)
+    if start < core_start:
+        weights *= np.clip((frame_nums - start + 0.5) / (2 * (core_start - start)), 0, 1)
+    if end > core_end:
+        weights *= np.clip((end - frame_nums - 0.5) / (2 * (end - core_end)), 0, 1)
+
+    return weights
+
+
+def _stabilize_segment(job):
+    input_video, patch_size, optimizer, start, end, warp_path, dtype, propagation_radius = job
+    cv2.setNumThreads(1)
+
+    video = cv2.VideoCapture(input_video)
+    motion = read_video(video, patch_size, start, end, dtype=dtype, propagation_radius=propagation_radius)
+    video.release()
+
+    opt_x_paths, opt_y_paths = stabilize(motion.x_paths, motion.y_paths, optimizer)
+    _, _, new_x_motion_patches, new_y_motion_patches = get_frame_warp(motion, opt_x_paths, opt_y_paths)
+    np.save(warp_path, np.stack((new_x_motion_patches, new_y_motion_patches)))
+
+    return warp_path
+
+
+def _render_segment(job):
+    input_video, k, segments, warp_paths, patch_size, border, png_dir, part_path = job
+    cv2.setNumThreads(1)
+
+    core_start, core_end, _, _ = segments[k]
+    frame_nums = np.arange(core_start, core_end)
+
+    # blend the mesh warps of every segment covering this core range
+    new_motion_patches, total = None, np.zeros(len(frame_nums))
+    for j, segment in enumerate(segments):
+        start, end = segment[2], segment[3]
+        if end <= core_start or start >= core_end:
+            continue
+        warps = np.load(warp_paths[j], mmap_mode='r')
+        inside = (frame_nums >= start) & (frame_nums < start + warps.shape[3])
+        weights = segment_weights(segment, frame_nums[inside])
+        if new_motion_patches is None:
+            new_motion_patches = np.zeros(warps.shape[:3] + (len(frame_nums),), warps.dtype)
+        new_motion_patches[..., inside] += weights * warps[..., frame_nums[inside] - start]
+        total[inside] += weights
+
+    # frames past a short decode are not covered by any segment
+    frame_count = len(frame_nums) if np.all(total > 0) else int(np.argmin(total > 0))
+    new_motion_patches = new_motion_patches[..., :frame_count] / total[:frame_count]
+
+    sink = PNGSink(png_dir, start=core_start) if png_dir is not None else NpySink(part_path)
+    video = cv2.VideoCapture(input_video)
+    generate_stabilized_video(video, None, None, new_motion_patches[0], new_motion_patches[1], None, None, patch_size, border, sink, start=core_start)
+    sink.close()
+
+    return None if png_dir is not None else part_path
+
+
+@timer
+def segment_stabilized_video(input_video, patch_size, border, sink, scratch_dir, segment_count, overlap=50, workers=1, optimizer='online', dtype=np.float64, propagation_radius=300):
+    """
+    Stabilize a long video as overlapping temporal segments in separate processes. Every segment runs
+    read_video, stabilize and get_frame_warp on its own frame range; the mesh warps of neighbouring
+    segments are blended linearly across the overlaps so seams don't show, and each segment then renders
+    its own frames with generate_stabilized_video.
+
+    Input:
+    input_video: path of the video, opened separately by every process
+    patch_size: block of size in patch
+    border: border cropped after warping
+    sink: output sink; a PNGSink is written by the segments directly, other sinks receive the segments' raw
+        frames in order as soon as each segment is done
+    scratch_dir: directory for the per-segment warps and frames, removed afterwards
+    segment_count: number of segments
+    overlap: frames each segment extends into its neighbours
+    workers: number of processes
+    optimizer: path optimizer of stabilize
+    dtype: precision of the motion patches, paths and mesh warps
+    propagation_radius: motion propagation radius, see coarse_stab.estimate_motion
+    """
+
+    video = cv2.VideoCapture(input_video)
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    video.release()
+
+    segments = segment_ranges(frame_count, segment_count, overlap)
+    mkdir_if_not_exist(scratch_dir)
+    warp_paths = [os.path.join(scratch_dir, 'warp_%03d.npy' % k) for k in range(segment_count)]
+    part_paths = [os.path.join(scratch_dir, 'frames_%03d.npy' % k) for k in range(segment_count)]
+    png_dir = sink.output_dir if isinstance(sink, PNGSink) else None
+
+    # spawn, so that workers don't inherit the parent's OpenCV / BLAS thread pools
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers) as pool:
+        pool.map(_stabilize_segment, [(input_video, patch_size, optimizer, start, end, warp_paths[k], dtype, propagation_radius)
+                                      for k, (_, _, start, end) in enumerate(segments)])
+
+        render_jobs = [(input_video, k, segments, warp_paths, patch_size, border, png_dir, part_paths[k]) for k in range(segment_count)]
+        for part_path in pool.imap(_render_segment, render_jobs):
+            if part_path is None or not os.path.exists(part_path):
+                continue
+            for frame in np.load(part_path, mmap_mode='r'):
+                sink.write(np.array(frame))
+            os.remove(part_path)
+
+    for warp_path in warp_paths:
+        os.remove(warp_path)
+    os.rmdir(scratch_dir)
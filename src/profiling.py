@@ -0,0 +1,194 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# Instrumentation of the stages and per-frame loops, off by default. While disabled span() returns a
+# shared no-op context manager and count() returns at once, so the instrumented code pays one call.
+_enabled = False
+_origin = time.perf_counter()
+_spans = []  # (path, start, duration, thread id), times in seconds since _origin
+_counters = []  # (name, time, value)
+_local = threading.local()
+
+# span duration histogram bins in seconds, 4 per decade from 1 us to 100 s
+HISTOGRAM_EDGES = 10 ** np.arange(-6, 2.01, 0.25)
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    """ Records its wall time under the path of the enclosing spans of the same thread, e.g. read_video/propagate/homography. """
+
+    __slots__ = ('path', 'start')
+
+    def __init__(self, name):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.path = stack[-1] + '/' + name if stack else name
+
+    def __enter__(self):
+        _local.stack.append(self.path)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter()
+        _local.stack.pop()
+        _spans.append((self.path, self.start - _origin, end - self.start, threading.get_ident()))
+        return False
+
+
+def enable():
+    """ Start recording spans and counters, clearing earlier records. """
+    global _enabled, _origin
+    del _spans[:]
+    del _counters[:]
+    _origin = time.perf_counter()
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def span(name):
+    """
+    Input:
+    name: name of the span, nested spans are recorded as parent/name
+
+    Output:
+    context manager timing its block while enabled
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def count(name, value):
+    """ Record one sample of a counter, e.g. the features tracked in a frame pair. """
+    if _enabled:
+        _counters.append((name, time.perf_counter() - _origin, value))
+
+
+def _stats(values):
+    values = np.asarray(values, dtype=np.float64)
+    return dict(count=len(values), total=float(values.sum()), mean=float(values.mean()), min=float(values.min()),
+                p50=float(np.percentile(values, 50)), p90=float(np.percentile(values, 90)),
+                p99=float(np.percentile(values, 99)), max=float(values.max()))
+
+
+def summary():
+    """
+    Output:
+    summary: dict with
+        spans: path -> count, total, mean, min, percentiles and max duration in seconds, and the
+            non-empty bins of the duration histogram as [lower, upper, count]
+        counters: name -> count, total, mean, min, percentiles and max of the samples
+    """
+
+    durations, samples = {}, {}
+    for path, _, duration, _ in _spans:
+        durations.setdefault(path, []).append(duration)
+    for name, _, value in _counters:
+        samples.setdefault(name, []).append(value)
+
+    spans = {}
+    for path, values in sorted(durations.items()):
+        spans[path] = _stats(values)
+        hist, edges = np.histogram(np.clip(values, HISTOGRAM_EDGES[0], HISTOGRAM_EDGES[-1]), HISTOGRAM_EDGES)
+        spans[path]['histogram'] = [[float(edges[i]), float(edges[i + 1]), int(n)] for i, n in enumerate(hist) if n > 0]
+
+    return dict(spans=spans, counters={name: _stats(values) for name, values in sorted(samples.items())})
+
+
+def chrome_trace():
+    """
+    Output:
+    trace: dict in the Chrome trace event format (chrome://tracing, Perfetto), spans as complete events
+        nested by time on their thread, counters as counter events
+    """
+
+    pid = os.getpid()
+    events = [dict(name=path.rsplit('/', 1)[-1], cat=path, ph='X', ts=start * 1e6, dur=duration * 1e6, pid=pid, tid=tid)
+              for path, start, duration, tid in _spans]
+    events += [dict(name=name, ph='C', ts=t * 1e6, pid=pid, args={name: value}) for name, t, value in _counters]
+    return dict(traceEvents=events, displayTimeUnit='ms')
+
+
+def print_summary(top=20):
+    """ Print the spans with the largest total time and the counters. """
+
+    results = summary()
+    spans = sorted(results['spans'].items(), key=lambda item: -item[1]['total'])[:top]
+    print('{0:<60} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10}'.format('span', 'count', 'total s', 'mean ms', 'p90 ms', 'max ms'))
+    for path, s in spans:
+        print('{0:<60} {1:>8} {2:>10.3f} {3:>10.3f} {4:>10.3f} {5:>10.3f}'.format(path, s['count'], s['total'], 1000 * s['mean'], 1000 * s['p90'], 1000 * s['max']))
+    for name, s in results['counters'].items():
+        print('{0:<60} {1:>8} mean {2:.1f} min {3:g} max {4:g}'.format(name, s['count'], s['mean'], s['min'], s['max']))
+
+
+def save(output_dir):
+    """ Write summary() to output_dir/profile.json and chrome_trace() to output_dir/trace.json. """
+
+    with open(os.path.join(output_dir, 'profile.json'), 'w') as f:
+        json.dump(summary(), f, indent=2)
+    with open(os.path.join(output_dir, 'trace.json'), 'w') as f:
+        json.dump(chrome_trace(), f)
+
+
+def start_profiler(kind):
+    """
+    Input:
+    kind: 'cprofile' or 'pyinstrument' (optional dependency), a function level profiler running next to the spans
+
+    Output:
+    profiler: the started profiler, to be passed to stop_profiler
+    """
+
+    if kind == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif kind == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImportError('--profiler pyinstrument needs the pyinstrument package')
+        profiler = Profiler()
+        profiler.start()
+    else:
+        raise ValueError('Unknown profiler: ' + kind)
+    return profiler
+
+
+def stop_profiler(profiler, kind, output_dir):
+    """ Stop the profiler of start_profiler and save cprofile.prof or pyinstrument.html to output_dir. """
+
+    if kind == 'cprofile':
+        import pstats
+        profiler.disable()
+        profiler.dump_stats(os.path.join(output_dir, 'cprofile.prof'))
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+    else:
+        profiler.stop()
+        with open(os.path.join(output_dir, 'pyinstrument.html'), 'w') as f:
+            f.write(profiler.output_html())
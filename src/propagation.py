@@ -1,163 +1,229 @@
+from functools import lru_cache
+
 import cv2
 import numpy as np
 from scipy.signal import medfilt
+from scipy.spatial import cKDTree
+
+from profiling import count, span
 
-from utils import init_dict, l2_dst
 
-def keypoint_transform(H, keypoint):
+def keypoints_transform(H, keypoints):
     """
     Input:
     H: homography matrix of dimension (3*3)
-    keypoint: the (x, y) point to be transformed
+    keypoints: N*2 array of (x, y) points to be transformed
 
     Output:
-    keypoint_trans: Transformed point keypoint_trans = H * (keypoint, 1)
+    keypoints_trans: N*2 array of transformed points, keypoints_trans = H * (keypoints, 1)
     """
 
-    keypoint = np.append(keypoint, 1)
-    a, b, c = np.dot(H, keypoint)
+    keypoints = np.asarray(keypoints, dtype=np.float64).reshape(-1, 2)
+    x, y = keypoints[:, 0], keypoints[:, 1]
+
+    a = H[0, 0] * x + H[0, 1] * y + H[0, 2]
+    b = H[1, 0] * x + H[1, 1] * y + H[1, 2]
+    c = H[2, 0] * x + H[2, 1] * y + H[2, 2]
+
+    return np.stack((a / c, b / c), axis=1)
+
+
+def mesh_vertices(rows, cols, PATCH_SIZE=16):
+    """
+    Input:
+    rows, cols: number of mesh vertices along y-direction and x-direction
 
-    keypoint_trans = np.array([[a/c, b/c]]).flatten()
+    Output:
+    vertices: (rows*cols)*2 array of (x, y) vertex positions in row-major order
+    """
 
-    return keypoint_trans
+    ys, xs = np.mgrid[0:rows, 0:cols]
+    return np.stack((xs.ravel(), ys.ravel()), axis=1) * PATCH_SIZE
 
 
-def propagate(input_points, output_points, input_frame, PATCH_SIZE=16, PROP_R=300):
+def propagate(input_points, output_points, input_frame, PATCH_SIZE=16, PROP_R=300, dtype=np.float64, return_homography=False):
     """
     Input:
     intput_points: points in input_frame which are matched feature points with output_frame
     output_points: points in input_frame which are matched feature points with intput_frame
     input_frame
     H: the homography between input and output points
+    dtype: dtype of the motion patches, the homography and residuals are computed in float64 regardless
+    return_homography: return the global homography as well
 
     Output: 
     x_motion_patch, y_motion_patch: Motion patch in x-direction and y-direction for input_frame
+    H: the global homography from input to output points, if return_homography
     """
 
     cols, rows = input_frame.shape[1] // PATCH_SIZE, input_frame.shape[0] // PATCH_SIZE
 
-    x_motion = init_dict(cols, rows)
-    y_motion = init_dict(cols, rows)
-    temp_x_motion = init_dict(cols, rows)
-    temp_y_motion = init_dict(cols, rows)
-
-    # pre-warping with global homography
-    H, _ = np.array(cv2.findHomography(input_points, output_points, cv2.RANSAC))
-    for i in range(rows):
-        for j in range(cols):
-            point = np.array([[PATCH_SIZE * j, PATCH_SIZE * i]])
-
-            point_trans = keypoint_transform(H, point)
+    input_points = np.asarray(input_points).reshape(-1, 2)
+    output_points = np.asarray(output_points).reshape(-1, 2)
+
+    # pre-warping with global homography, all vertices at once
+    with span('homography'):
+        H, inliers = cv2.findHomography(input_points, output_points, cv2.RANSAC)
+    count('ransac_inliers', int(inliers.sum()) if inliers is not None else 0)
+    vertices = mesh_vertices(rows, cols, PATCH_SIZE)
+    vertices_trans = keypoints_transform(H, vertices)
+    x_motion = vertices[:, 0] - vertices_trans[:, 0]
+    y_motion = vertices[:, 1] - vertices_trans[:, 1]
+
+    # residual feature motion after the global homography
+    points_trans = keypoints_transform(H, input_points)
+    x_residual = output_points[:, 0] - points_trans[:, 0]
+    y_residual = output_points[:, 1] - points_trans[:, 1]
+
+    # distribute feature motion vectors: find (vertex, feature) pairs within PROP_R
+    # with a KD-tree, then keep the exact strict distance test
+    neighbours = cKDTree(input_points).query_ball_point(vertices, PROP_R)
+    counts = np.fromiter((len(n) for n in neighbours), dtype=np.intp, count=len(neighbours))
+    vertex_idx = np.repeat(np.arange(len(neighbours)), counts)
+    feature_idx = np.concatenate([np.asarray(n, dtype=np.intp) for n in neighbours] + [np.zeros(0, np.intp)])
+
+    distance = np.sqrt(
+        (input_points[feature_idx, 0] - vertices[vertex_idx, 0])**2 +
+        (input_points[feature_idx, 1] - vertices[vertex_idx, 1])**2)
+    inside = distance < PROP_R
+    vertex_idx, feature_idx = vertex_idx[inside], feature_idx[inside]
+
+    # Apply one Median Filter on obtained motion for each vertex. Every vertex holds a
+    # single candidate, the last feature (in input order) within PROP_R, or 0 if none.
+    last = np.full(rows * cols, -1, dtype=np.intp)
+    np.maximum.at(last, vertex_idx, feature_idx)
+    found = last >= 0
+
+    x_temp = np.where(found, x_residual[last], 0)
+    y_temp = np.where(found, y_residual[last], 0)
+
+    x_motion_patch = (x_motion + x_temp).reshape(rows, cols)
+    y_motion_patch = (y_motion + y_temp).reshape(rows, cols)
 
-            x_motion[i, j] = point.flatten()[0] - point_trans[0]
-            y_motion[i, j] = point.flatten()[1] - point_trans[1]
-
-    # distribute feature motion vectors
-    for i in range(rows):
-        for j in range(cols):
-            vertex = np.array([[PATCH_SIZE * j, PATCH_SIZE * i]])
-            for in_point, out_point in zip(input_points, output_points):
-                # velocity = point - feature point in current frame
+    # Apply the other Median Filter over the motion patch for outliers
+    x_motion_patch = medfilt(x_motion_patch, kernel_size=[3, 3])
+    y_motion_patch = medfilt(y_motion_patch, kernel_size=[3, 3])
 
-                distance = l2_dst(in_point, vertex)
-                if distance < PROP_R:
-                    point_trans = keypoint_transform(H, in_point)
+    x_motion_patch, y_motion_patch = x_motion_patch.astype(dtype, copy=False), y_motion_patch.astype(dtype, copy=False)
+    if return_homography:
+        return x_motion_patch, y_motion_patch, H
+    return x_motion_patch, y_motion_patch
 
-                    temp_x_motion[i, j] = [out_point[0] - point_trans[0]]
-                    temp_y_motion[i, j] = [out_point[1] - point_trans[1]]
 
-    # Apply one Median Filter on obtained motion for each vertex
-    x_motion_patch = np.zeros((rows, cols), dtype=float)
-    y_motion_patch = np.zeros((rows, cols), dtype=float)
+@lru_cache(maxsize=8)
+def cell_pixel_grid(rows, cols, PATCH_SIZE=16):
+    """
+    Input:
+    rows, cols: number of mesh cells along y-direction and x-direction
 
-    for key in x_motion.keys():
+    Output:
+    grid_x, grid_y: (rows, cols, PATCH_SIZE, PATCH_SIZE) pixel coordinates of every mesh cell,
+    cached since they only depend on the mesh layout
+    """
 
-        temp_x_motion[key].sort()
-        temp_y_motion[key].sort()
-        x_motion_patch[key] = x_motion[key] + temp_x_motion[key][len(temp_x_motion[key]) // 2]
-        y_motion_patch[key] = y_motion[key] + temp_y_motion[key][len(temp_y_motion[key]) // 2]
+    offset_y, offset_x = np.mgrid[0:PATCH_SIZE, 0:PATCH_SIZE].astype(np.float64)
+    origin_y, origin_x = np.mgrid[0:rows, 0:cols].astype(np.float64) * PATCH_SIZE
 
-    # Apply the other Median Filter over the motion patch for outliers
-    x_motion_patch = medfilt(x_motion_patch, kernel_size=[3, 3])
-    y_motion_patch = medfilt(y_motion_patch, kernel_size=[3, 3])
+    grid_x = origin_x[:, :, None, None] + offset_x[None, None, :, :]
+    grid_y = origin_y[:, :, None, None] + offset_y[None, None, :, :]
+    grid_x.setflags(write=False)
+    grid_y.setflags(write=False)
 
-    return x_motion_patch, y_motion_patch
+    return grid_x, grid_y
 
 
-def vertex_motion_path(x_path, y_path, x_motion_patch, y_motion_patch):
+def cell_homographies(x_motion_patch, y_motion_patch, PATCH_SIZE=16):
     """
     Input:
-    x_path: motion path along x_direction
-    y_path: motion path along y_direction
-    x_motion_patch: obtained motion patch along x_direction
-    y_motion_patch: obtained motion patch along y_direction
-    
+    x_motion_patch: the motion_patch on mesh vertices along x-direction
+    y_motion_patch: the motion_patch on mesh vertices along y-direction
+
     Output:
-    x_paths, y_paths: Updated x_paths, y_paths with new x_motion_patch, y_motion_patch added to the last x_paths, y_paths
+    H: (rows-1, cols-1, 3, 3) homographies mapping each mesh cell onto its displaced corners,
+    solved together with the 4-point DLT (h33 = 1)
     """
 
-    x_path_new = x_path[:, :, -1] + x_motion_patch
-    y_path_new = y_path[:, :, -1] + y_motion_patch
-    x_paths = np.concatenate((x_path, np.expand_dims(x_path_new, axis=2)), axis=2)
-    y_paths = np.concatenate((y_path, np.expand_dims(y_path_new, axis=2)), axis=2)
+    rows, cols = x_motion_patch.shape[0] - 1, x_motion_patch.shape[1] - 1
+    y, x = np.mgrid[0:rows, 0:cols].astype(np.float64) * PATCH_SIZE
+    x_next, y_next = x + PATCH_SIZE, y + PATCH_SIZE
 
-    return x_paths, y_paths
+    # corners in the same order as before: (x, y), (x, y_next), (x_next, y), (x_next, y_next)
+    src_x = np.stack((x, x, x_next, x_next), axis=-1)
+    src_y = np.stack((y, y_next, y, y_next), axis=-1)
+    dst_x = src_x + np.stack((x_motion_patch[:-1, :-1], x_motion_patch[1:, :-1],
+                              x_motion_patch[:-1, 1:], x_motion_patch[1:, 1:]), axis=-1)
+    dst_y = src_y + np.stack((y_motion_patch[:-1, :-1], y_motion_patch[1:, :-1],
+                              y_motion_patch[:-1, 1:], y_motion_patch[1:, 1:]), axis=-1)
 
+    ones, zeros = np.ones_like(src_x), np.zeros_like(src_x)
+    A = np.concatenate((
+        np.stack((src_x, src_y, ones, zeros, zeros, zeros, -src_x * dst_x, -src_y * dst_x), axis=-1),
+        np.stack((zeros, zeros, zeros, src_x, src_y, ones, -src_x * dst_y, -src_y * dst_y), axis=-1)),
+        axis=-2)
+    b = np.concatenate((dst_x, dst_y), axis=-1)
 
-def warp_frame(frame, x_motion_patch, y_motion_patch, PATCH_SIZE=16):
+    h = np.linalg.solve(A, b[..., None])[..., 0]
+    H = np.concatenate((h, np.ones((rows, cols, 1))), axis=-1).reshape(rows, cols, 3, 3)
+
+    return H
+
+
+def warp_maps(x_motion_patch, y_motion_patch, height, width, PATCH_SIZE=16):
     """
     Input:
-    frame is the current frame
     x_motion_patch: the motion_patch to be warped on frame along x-direction
     y_motion_patch: the motion patch to be warped on frame along y-direction
-    
+    height, width: size of the frame
+
     Output:
-    new_frame: a warped frame according to given motion patches x_motion_patch, y_motion_patch
+    map_x, map_y: float32 maps for cv2.remap
     """
 
-    map_x = np.zeros((frame.shape[0], frame.shape[1]), np.float32)
-    map_y = np.zeros((frame.shape[0], frame.shape[1]), np.float32)
+    H = cell_homographies(x_motion_patch, y_motion_patch, PATCH_SIZE)
+    rows, cols = H.shape[0], H.shape[1]
+    grid_x, grid_y = cell_pixel_grid(rows, cols, PATCH_SIZE)
 
-    for i in range(x_motion_patch.shape[0] - 1):
-        for j in range(x_motion_patch.shape[1] - 1):
+    H = H[:, :, :, :, None, None]
+    x_res = H[:, :, 0, 0] * grid_x + H[:, :, 0, 1] * grid_y + H[:, :, 0, 2]
+    y_res = H[:, :, 1, 0] * grid_x + H[:, :, 1, 1] * grid_y + H[:, :, 1, 2]
+    w_res = H[:, :, 2, 0] * grid_x + H[:, :, 2, 1] * grid_y + H[:, :, 2, 2]
 
-            x, y = int(j * PATCH_SIZE), int(i * PATCH_SIZE)
-            x_next, y_next = int((j+1) * PATCH_SIZE), int((i+1) * PATCH_SIZE)
+    valid = w_res != 0
+    w_res = np.where(valid, w_res, 1)
+    x_res = np.where(valid, x_res / w_res, grid_x)
+    y_res = np.where(valid, y_res / w_res, grid_y)
 
-            src = np.array(
-                [[x, y], [x, y_next], [x_next, y], [x_next, y_next]]
-                )
+    # (rows, cols, PATCH_SIZE, PATCH_SIZE) -> image layout
+    mesh_h, mesh_w = rows * PATCH_SIZE, cols * PATCH_SIZE
+    map_x = np.zeros((height, width), np.float32)
+    map_y = np.zeros((height, width), np.float32)
+    map_x[:mesh_h, :mesh_w] = x_res.transpose(0, 2, 1, 3).reshape(mesh_h, mesh_w)[:height, :width]
+    map_y[:mesh_h, :mesh_w] = y_res.transpose(0, 2, 1, 3).reshape(mesh_h, mesh_w)[:height, :width]
 
-            dst = np.array(
-                [[x + x_motion_patch[i, j], y + y_motion_patch[i, j]],
-                 [x + x_motion_patch[i+1, j], y_next + y_motion_patch[i+1, j]],
-                 [x_next + x_motion_patch[i, j+1], y + y_motion_patch[i, j+1]],
-                 [x_next + x_motion_patch[i+1, j+1], y_next + y_motion_patch[i+1, j+1]]]
-                 )
+    # repeat motion vectors of the last mesh column / row for remaining frame
+    map_x[:mesh_h, mesh_w:] = map_x[:mesh_h, mesh_w - 1:mesh_w]
+    map_y[:mesh_h, mesh_w:] = map_y[:mesh_h, mesh_w - 1:mesh_w]
+    map_x[mesh_h:, :] = map_x[mesh_h - 1:mesh_h, :]
+    map_y[mesh_h:, :] = map_y[mesh_h - 1:mesh_h, :]
 
-            H, _ = cv2.findHomography(src, dst, cv2.RANSAC)
+    return map_x, map_y
 
-            for k in range(y, y_next):
-                for l in range(x, x_next):
 
-                    x_res, y_res, w_res = np.dot(H, np.append(np.array([[l, k]]), 1))
-                    if w_res != 0:
-                        x_res, y_res = x_res / (w_res*1.0), y_res / (w_res*1.0)
-                    else:
-                        x_res, y_res = l, k
-                    map_x[k, l] = x_res
-                    map_y[k, l] = y_res
-
-    # repeat motion vectors for remaining frame in x-direction
-    for j in range(PATCH_SIZE*x_motion_patch.shape[1], map_x.shape[1]):
-        map_x[:, j] = map_x[:, PATCH_SIZE * x_motion_patch.shape[0] - 1]
-        map_y[:, j] = map_y[:, PATCH_SIZE * x_motion_patch.shape[0] - 1]
+def warp_frame(frame, x_motion_patch, y_motion_patch, PATCH_SIZE=16):
+    """
+    Input:
+    frame is the current frame
+    x_motion_patch: the motion_patch to be warped on frame along x-direction
+    y_motion_patch: the motion patch to be warped on frame along y-direction
+    
+    Output:
+    new_frame: a warped frame according to given motion patches x_motion_patch, y_motion_patch
+    """
 
-    # repeat motion vectors for remaining frame in y-direction
-    for i in range(PATCH_SIZE*x_motion_patch.shape[0], map_x.shape[0]):
-        map_x[i, :] = map_x[PATCH_SIZE * x_motion_patch.shape[0] - 1, :]
-        map_y[i, :] = map_y[PATCH_SIZE * x_motion_patch.shape[0] - 1, :]
+    with span('warp_maps'):
+        map_x, map_y = warp_maps(x_motion_patch, y_motion_patch, frame.shape[0], frame.shape[1], PATCH_SIZE)
 
     # deforms patch
-    new_frame = cv2.remap(frame, map_x, map_y, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+    with span('remap'):
+        new_frame = cv2.remap(frame, map_x, map_y, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
     return new_frame
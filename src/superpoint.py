@@ -1,5 +1,14 @@
+import copy
+import hashlib
+import json
+import os
+
 import numpy as np
 import torch
+from scipy.ndimage import maximum_filter, minimum_filter
+from scipy.spatial import cKDTree
+
+from utils import mkdir_if_not_exist
 
 
 class SuperPointNet(torch.nn.Module):
@@ -41,11 +50,12 @@ class SuperPointNet(torch.nn.Module):
         self.convDb = torch.nn.Conv2d(
             c5, d1, kernel_size=1, stride=1, padding=0)
 
-    def forward(self, x):
+    def forward(self, x, descriptors=True):
         """ 
         Forward pass that jointly computes unprocessed point and descriptor tensors.
         Input
         x: Image pytorch tensor shaped N x 1 x H x W.
+        descriptors: Run the descriptor head, skipped (desc is None) when False.
         Output
         semi: Output point pytorch tensor shaped N x 65 x H/8 x W/8.
         desc: Output descriptor pytorch tensor shaped N x 256 x H/8 x W/8.
@@ -65,6 +75,8 @@ class SuperPointNet(torch.nn.Module):
         # Detector Head.
         cPa = self.relu(self.convPa(x))
         semi = self.convPb(cPa)
+        if not descriptors:
+            return semi, None
         # Descriptor Head.
         cDa = self.relu(self.convDa(x))
         desc = self.convDb(cDa)
@@ -73,10 +85,74 @@ class SuperPointNet(torch.nn.Module):
         return semi, desc
 
 
+class SuperPointExport(torch.nn.Module):
+    """
+    SuperPointNet rearranged for export: every conv gets its own ReLU so conv+relu pairs can be
+    fused, quant/dequant stubs wrap the int8 part, and forward has a fixed signature for tracing.
+    """
+
+    def __init__(self, net, descriptors=False):
+        super(SuperPointExport, self).__init__()
+        self.descriptors = descriptors
+        relu = lambda: torch.nn.ReLU(inplace=True)
+        pool = lambda: torch.nn.MaxPool2d(kernel_size=2, stride=2)
+        self.quant = torch.ao.quantization.QuantStub()
+        self.dequant = torch.ao.quantization.DeQuantStub()
+        # Shared Encoder.
+        self.encoder = torch.nn.Sequential(
+            net.conv1a, relu(), net.conv1b, relu(), pool(),
+            net.conv2a, relu(), net.conv2b, relu(), pool(),
+            net.conv3a, relu(), net.conv3b, relu(), pool(),
+            net.conv4a, relu(), net.conv4b, relu())
+        # Detector Head.
+        self.detector = torch.nn.Sequential(net.convPa, relu(), net.convPb)
+        # Descriptor Head.
+        if descriptors:
+            self.descriptor = torch.nn.Sequential(net.convDa, relu(), net.convDb)
+
+    def fuse(self):
+        """ Fuse every conv with the ReLU following it. """
+        for name in ('encoder', 'detector', 'descriptor'):
+            seq = getattr(self, name, None)
+            if seq is None:
+                continue
+            pairs = [[name + '.' + str(i), name + '.' + str(i + 1)] for i in range(len(seq) - 1)
+                     if isinstance(seq[i], torch.nn.Conv2d) and isinstance(seq[i + 1], torch.nn.ReLU)]
+            torch.ao.quantization.fuse_modules(self, pairs, inplace=True)
+
+    def forward(self, x):
+        x = self.encoder(self.quant(x))
+        semi = self.dequant(self.detector(x))
+        if not self.descriptors:
+            return semi
+        desc = self.dequant(self.descriptor(x))
+        dn = torch.norm(desc, p=2, dim=1)  # Compute the norm.
+        desc = desc.div(torch.unsqueeze(dn, 1))  # Divide by norm to normalize.
+        return semi, desc
+
+
+class CompiledSuperPointNet(object):
+    """ Adapter giving a TorchScript SuperPoint of export_superpoint the forward of SuperPointNet. """
+
+    def __init__(self, path):
+        extra = {'superpoint.json': ''}
+        self.module = torch.jit.load(path, map_location='cpu', _extra_files=extra)
+        self.meta = json.loads(extra['superpoint.json'])
+        self.descriptors = self.meta['descriptors']
+
+    def forward(self, x, descriptors=True):
+        if descriptors and not self.descriptors:
+            raise ValueError('Compiled SuperPoint was exported without the descriptor head')
+        out = self.module(x)
+        if not self.descriptors:
+            return out, None
+        return out if descriptors else (out[0], None)
+
+
 class SuperPointWrapper(object):
     """ Wrapper around pytorch net to help with pre and post image processing. """
 
-    def __init__(self, weights_path, nms_dist=2, conf_thresh=1e-5, nn_thresh=0.7, cuda=False):
+    def __init__(self, weights_path, nms_dist=2, conf_thresh=1e-5, nn_thresh=0.7, cuda=False, threads=None, compiled_path=None):
         self.name = 'SuperPoint'
         self.cuda = cuda
         self.nms_dist = nms_dist
@@ -84,8 +160,16 @@ class SuperPointWrapper(object):
         self.nn_thresh = nn_thresh  # L2 descriptor distance for good match.
         self.cell = 8  # Size of each output cell. Keep this fixed.
         self.border_remove = 4  # Remove points this close to the border.
+        if threads is not None:
+            # Intra-op threads of CPU inference.
+            torch.set_num_threads(threads)
 
         # Load the network in inference mode.
+        if compiled_path is not None:
+            # TorchScript / int8 export of export_superpoint, a CPU deployment.
+            self.cuda = False
+            self.net = CompiledSuperPointNet(compiled_path)
+            return
         self.net = SuperPointNet()
         if cuda:
             # Train on GPU, deploy on GPU.
@@ -102,14 +186,12 @@ class SuperPointWrapper(object):
         Run a faster approximate Non-Max-Suppression on numpy corners shaped:
             3xN [x_i,y_i,conf_i]^T
 
-        Algo summary: Create a grid sized HxW. Assign each corner location a 1, rest
-        are zeros. Iterate through all the 1's and convert them either to -1 or 0.
-        Suppress points by setting nearby values to 0.
-
-        Grid Value Legend:
-            -1 : Kept.
-            0 : Empty or suppressed.
-            1 : To be processed (converted to either kept or supressed).
+        Algo summary: Greedy NMS in confidence order (a corner is kept unless a kept,
+        more confident corner lies within dist_thresh), resolved in parallel rounds on
+        a HxW grid of confidence ranks: every undecided corner that is the most
+        confident undecided corner of its neighbourhood is kept, and the undecided
+        corners around it are suppressed. Each round is a minimum / maximum filter
+        over the grid, and the rounds keep the same corners as the sequential loop.
 
         NOTE: The NMS first rounds points to integers, so NMS distance might not
         be exactly dist_thresh. It also assumes points are within image boundaries.
@@ -123,8 +205,6 @@ class SuperPointWrapper(object):
             nmsed_corners - 3xN numpy matrix with surviving corners.
             nmsed_inds - N length numpy vector with surviving corner indices.
         """
-        grid = np.zeros((H, W)).astype(int)  # Track NMS data.
-        inds = np.zeros((H, W)).astype(int)  # Store indices of points.
         # Sort by confidence and round to nearest int.
         inds1 = np.argsort(-in_corners[2, :])
         corners = in_corners[:, inds1]
@@ -135,25 +215,30 @@ class SuperPointWrapper(object):
         if rcorners.shape[1] == 1:
             out = np.vstack((rcorners, in_corners[2])).reshape(3, 1)
             return out, np.zeros((1)).astype(int)
-        # Initialize the grid.
-        for i, rc in enumerate(rcorners.T):
-            grid[rcorners[1, i], rcorners[0, i]] = 1
-            inds[rcorners[1, i], rcorners[0, i]] = i
-        # Pad the border of the grid, so that we can NMS points near the border.
-        pad = dist_thresh
-        grid = np.pad(grid, ((pad, pad), (pad, pad)), mode='constant')
-        # Iterate through points, highest to lowest conf, suppress neighborhood.
-        count = 0
-        for i, rc in enumerate(rcorners.T):
-            # Account for top and left padding.
-            pt = (rc[0]+pad, rc[1]+pad)
-            if grid[pt[1], pt[0]] == 1:  # If not yet suppressed.
-                grid[pt[1]-pad:pt[1]+pad+1, pt[0]-pad:pt[0]+pad+1] = 0
-                grid[pt[1], pt[0]] = -1
-                count += 1
-        # Get all surviving -1's and return sorted array of remaining corners.
-        keepy, keepx = np.where(grid == -1)
-        keepy, keepx = keepy - pad, keepx - pad
+        N = rcorners.shape[1]
+        loc = rcorners[1, :] * W + rcorners[0, :]
+        # Rank grid: the most confident corner at each location, N where empty.
+        locs, first = np.unique(loc, return_index=True)
+        rank = np.full(H * W, N, dtype=np.intp)
+        rank[locs] = first
+        # Corner reported for each location: the least confident duplicate, like the
+        # sequential version whose index grid was overwritten in confidence order.
+        _, last = np.unique(loc[::-1], return_index=True)
+        inds = np.zeros(H * W, dtype=np.intp)
+        inds[locs] = N - 1 - last
+        rank, inds = rank.reshape(H, W), inds.reshape(H, W)
+        # Resolve the greedy suppression in rounds.
+        size = 2 * dist_thresh + 1
+        kept = np.zeros((H, W), dtype=bool)
+        while True:
+            local_min = minimum_filter(rank, size=size, mode='constant', cval=N)
+            new = (rank < N) & (rank == local_min)
+            if not new.any():
+                break
+            kept |= new
+            rank[maximum_filter(new, size=size, mode='constant', cval=0)] = N
+        # Get all surviving corners and return sorted array of remaining corners.
+        keepy, keepx = np.nonzero(kept)
         inds_keep = inds[keepy, keepx]
         out = corners[:, inds_keep]
         values = out[-1, :]
@@ -162,48 +247,87 @@ class SuperPointWrapper(object):
         out_inds = inds1[inds_keep[inds2]]
         return out, out_inds
 
-    def run(self, img):
+    def run(self, img, descriptors=True, heatmap=True):
         """ Process a numpy image to extract points and descriptors.
         Input
             img - HxW numpy float32 input image in range [0,1].
+            descriptors - Compute descriptors, desc is None when False.
+            heatmap - Assemble the full resolution heatmap, None when False.
         Output
             corners - 3xN numpy array with corners [x_i, y_i, confidence_i]^T.
             desc - 256xN numpy array of corresponding unit normalized descriptors.
             heatmap - HxW numpy heatmap in range [0,1] of point confidences.
             """
-        assert img.ndim == 2, 'Image must be grayscale.'
-        assert img.dtype == np.float32, 'Image must be float32.'
-        H, W = img.shape[0], img.shape[1]
-        inp = img.copy()
-        inp = (inp.reshape(1, H, W))
-        inp = torch.from_numpy(inp)
-        inp = torch.autograd.Variable(inp).view(1, 1, H, W)
+        return self.run_batch([img], descriptors, heatmap)[0]
+
+    def run_batch(self, imgs, descriptors=True, heatmap=True):
+        """ Process numpy images of the same size in a single forward pass.
+        Input
+            imgs - list of HxW (or NxHxW) numpy float32 input images in range [0,1].
+            descriptors - Compute descriptors; the descriptor head is skipped and desc
+                is None when False, e.g. when only keypoints are tracked.
+            heatmap - Assemble the full resolution heatmaps, None when False.
+        Output
+            results - list of (corners, desc, heatmap) per image, as returned by run.
+            """
+        imgs = np.asarray(imgs)
+        assert imgs.ndim == 3, 'Images must be grayscale.'
+        assert imgs.dtype == np.float32, 'Images must be float32.'
+        N, H, W = imgs.shape
+        inp = torch.from_numpy(np.ascontiguousarray(imgs)).view(N, 1, H, W)
         if self.cuda:
             inp = inp.cuda()
-        # Forward pass of network.
-        outs = self.net.forward(inp)
-        semi, coarse_desc = outs[0], outs[1]
-        # Convert pytorch -> numpy.
-        semi = semi.data.cpu().numpy().squeeze()
+        # Forward pass of network, without autograd bookkeeping.
+        with torch.inference_mode():
+            semi, coarse_desc = self.net.forward(inp, descriptors)
+            # Convert pytorch -> numpy.
+            semi = semi.cpu().numpy()
+            results = []
+            for i in range(N):
+                pts, heat = self.process_points(semi[i], H, W, heatmap)
+                if pts is None:
+                    results.append((np.zeros((3, 0)), None, None))
+                    continue
+                desc = self.sample_descriptors(pts, coarse_desc[i:i+1], H, W) if descriptors else None
+                results.append((pts, desc, heat))
+        return results
+
+    def process_points(self, semi, H, W, heatmap=True):
+        """ Turn the raw detector output of one image into NMSed corners.
+        Input
+            semi - 65xH/8xW/8 numpy detector output.
+            H, W - Image height and width.
+            heatmap - Assemble the full resolution heatmap, None when False.
+        Output
+            corners - 3xN numpy array with corners [x_i, y_i, confidence_i]^T, None if no point passes conf_thresh.
+            heatmap - HxW numpy heatmap in range [0,1] of point confidences.
+            """
         # --- Process points.
         dense = np.exp(semi)  # Softmax.
         dense = dense / (np.sum(dense, axis=0)+.00001)  # Should sum to 1.
         # Remove dustbin.
         nodust = dense[:-1, :, :]
-        # Reshape to get full resolution heatmap.
         Hc = int(H / self.cell)
         Wc = int(W / self.cell)
-        nodust = nodust.transpose(1, 2, 0)
-        heatmap = np.reshape(nodust, [Hc, Wc, self.cell, self.cell])
-        heatmap = np.transpose(heatmap, [0, 2, 1, 3])
-        heatmap = np.reshape(heatmap, [Hc*self.cell, Wc*self.cell])
-        xs, ys = np.where(heatmap >= self.conf_thresh)  # Confidence threshold.
-        if len(xs) == 0:
-            return np.zeros((3, 0)), None, None
+        # Confidence threshold on the cell layout, channel c of cell (i, j) is pixel
+        # (i*cell + c//cell, j*cell + c%cell), listed in row-major pixel order.
+        c, i, j = np.nonzero(nodust >= self.conf_thresh)
+        if len(c) == 0:
+            return None, None
+        xs = i * self.cell + c // self.cell
+        ys = j * self.cell + c % self.cell
+        order = np.argsort(xs * (Wc*self.cell) + ys)
         pts = np.zeros((3, len(xs)))  # Populate point data sized 3xN.
-        pts[0, :] = ys
-        pts[1, :] = xs
-        pts[2, :] = heatmap[xs, ys]
+        pts[0, :] = ys[order]
+        pts[1, :] = xs[order]
+        pts[2, :] = nodust[c[order], i[order], j[order]]
+        heat = None
+        if heatmap:
+            # Reshape to get full resolution heatmap.
+            heat = nodust.transpose(1, 2, 0)
+            heat = np.reshape(heat, [Hc, Wc, self.cell, self.cell])
+            heat = np.transpose(heat, [0, 2, 1, 3])
+            heat = np.reshape(heat, [Hc*self.cell, Wc*self.cell])
         # Apply NMS.
         pts, _ = self.nms_fast(pts, H, W, dist_thresh=self.nms_dist)
         inds = np.argsort(pts[2, :])
@@ -214,21 +338,130 @@ class SuperPointWrapper(object):
         toremoveH = np.logical_or(pts[1, :] < bord, pts[1, :] >= (H-bord))
         toremove = np.logical_or(toremoveW, toremoveH)
         pts = pts[:, ~toremove]
+        return pts, heat
+
+    def sample_descriptors(self, pts, coarse_desc, H, W):
+        """ Interpolate the descriptors of corners from the coarse descriptor map.
+        Input
+            pts - 3xN numpy array with corners.
+            coarse_desc - 1x256xH/8xW/8 pytorch descriptor tensor of the image.
+            H, W - Image height and width.
+        Output
+            desc - 256xN numpy array of corresponding unit normalized descriptors.
+            """
         # --- Process descriptor.
         D = coarse_desc.shape[1]
         if pts.shape[1] == 0:
-            desc = np.zeros((D, 0))
-        else:
-            # Interpolate into descriptor map using 2D point locations.
-            samp_pts = torch.from_numpy(pts[:2, :].copy())
-            samp_pts[0, :] = (samp_pts[0, :] / (float(W)/2.)) - 1.
-            samp_pts[1, :] = (samp_pts[1, :] / (float(H)/2.)) - 1.
-            samp_pts = samp_pts.transpose(0, 1).contiguous()
-            samp_pts = samp_pts.view(1, 1, -1, 2)
-            samp_pts = samp_pts.float()
-            if self.cuda:
-                samp_pts = samp_pts.cuda()
-                desc = torch.nn.functional.grid_sample(coarse_desc, samp_pts)
-                desc = desc.data.cpu().numpy().reshape(D, -1)
-                desc /= np.linalg.norm(desc, axis=0)[np.newaxis, :]
-        return pts, desc, heatmap
+            return np.zeros((D, 0))
+        # Interpolate into descriptor map using 2D point locations.
+        samp_pts = torch.from_numpy(pts[:2, :].copy())
+        samp_pts[0, :] = (samp_pts[0, :] / (float(W)/2.)) - 1.
+        samp_pts[1, :] = (samp_pts[1, :] / (float(H)/2.)) - 1.
+        samp_pts = samp_pts.transpose(0, 1).contiguous()
+        samp_pts = samp_pts.view(1, 1, -1, 2)
+        samp_pts = samp_pts.float()
+        if self.cuda:
+            samp_pts = samp_pts.cuda()
+        desc = torch.nn.functional.grid_sample(coarse_desc, samp_pts, align_corners=False)
+        desc = desc.cpu().numpy().reshape(D, -1)
+        desc /= np.linalg.norm(desc, axis=0)[np.newaxis, :]
+        return desc
+
+
+def keypoint_parity(reference, candidate, imgs, max_dist=2, top_k=500):
+    """
+    Input:
+    reference, candidate: SuperPointWrappers, e.g. the fp32 network and a compiled export
+    imgs: HxW float32 images in range [0,1]
+    max_dist: distance in pixels within which a keypoint counts as reproduced
+    top_k: strongest reference keypoints compared per image
+
+    Output:
+    parity: fraction of the reference keypoints with a candidate keypoint within max_dist
+    """
+
+    found, total = 0, 0
+    for img in imgs:
+        ref_pts = reference.run(img, descriptors=False, heatmap=False)[0][:2, :top_k].T
+        cand_pts = candidate.run(img, descriptors=False, heatmap=False)[0][:2, :].T
+        total += len(ref_pts)
+        if len(ref_pts) == 0 or len(cand_pts) == 0:
+            continue
+        dist, _ = cKDTree(cand_pts).query(ref_pts, distance_upper_bound=max_dist)
+        found += int(np.sum(np.isfinite(dist)))
+
+    return found / total if total > 0 else 1.0
+
+
+def export_superpoint(weights_path, export_path, calibration, quantize='static', descriptors=False, min_parity=0.9):
+    """
+    Trace SuperPoint with TorchScript, optionally int8-quantized, and save it for SuperPointWrapper(compiled_path=...).
+
+    Input:
+    weights_path: fp32 weights, e.g. superpoint_v1.pth
+    export_path: file of the TorchScript module
+    calibration: HxW float32 images in range [0,1] of the deployment's frame size; used to trace,
+        to calibrate the int8 activation ranges and for the parity check
+    quantize: 'static' for int8 weights and activations (x86/fbgemm kernels), None for fp32. Dynamic
+        quantization is not offered since it has no int8 kernels for Conv2d.
+    descriptors: export the descriptor head as well
+    min_parity: least keypoint_parity against the fp32 network, the export fails below it
+
+    Output:
+    parity: keypoint_parity of the export against the fp32 network
+    """
+
+    if quantize not in (None, 'static'):
+        raise ValueError('Unknown quantization: ' + str(quantize))
+
+    reference = SuperPointWrapper(weights_path, cuda=False)
+    module = SuperPointExport(copy.deepcopy(reference.net), descriptors).eval()
+    imgs = [torch.from_numpy(np.ascontiguousarray(img, dtype=np.float32))[None, None] for img in calibration]
+
+    with torch.inference_mode():
+        if quantize == 'static':
+            module.fuse()
+            module.qconfig = torch.ao.quantization.get_default_qconfig(torch.backends.quantized.engine)
+            torch.ao.quantization.prepare(module, inplace=True)
+            for inp in imgs:
+                module(inp)
+            torch.ao.quantization.convert(module, inplace=True)
+
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(module, imgs[0]))
+
+    meta = {'descriptors': descriptors, 'quantize': quantize, 'torch': torch.__version__}
+    tmp_path = export_path + '.tmp'
+    torch.jit.save(traced, tmp_path, _extra_files={'superpoint.json': json.dumps(meta)})
+
+    parity = keypoint_parity(reference, SuperPointWrapper(weights_path, compiled_path=tmp_path), calibration)
+    if parity < min_parity:
+        os.remove(tmp_path)
+        raise RuntimeError('Exported SuperPoint reproduces only {:.1%} of the fp32 keypoints'.format(parity))
+    os.replace(tmp_path, export_path)
+
+    return parity
+
+
+def compiled_superpoint(weights_path, cache_dir, calibration, quantize='static', descriptors=False, min_parity=0.9):
+    """
+    Input:
+    weights_path, calibration, quantize, descriptors, min_parity: see export_superpoint
+    cache_dir: directory of compiled models
+
+    Output:
+    compiled_path: TorchScript SuperPoint for SuperPointWrapper(compiled_path=...), exported on the first call
+    and reused while the weights, options and torch version stay the same
+    """
+
+    sha1 = hashlib.sha1()
+    with open(weights_path, 'rb') as f:
+        sha1.update(f.read())
+    sha1.update(json.dumps({'quantize': quantize, 'descriptors': descriptors, 'torch': torch.__version__}, sort_keys=True).encode('utf-8'))
+    compiled_path = os.path.join(cache_dir, 'superpoint_' + sha1.hexdigest() + '.pt')
+
+    if not os.path.exists(compiled_path):
+        mkdir_if_not_exist(cache_dir)
+        export_superpoint(weights_path, compiled_path, calibration, quantize, descriptors, min_parity)
+
+    return compiled_path
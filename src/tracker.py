@@ -0,0 +1,152 @@
+import cv2
+import numpy as np
+
+
+def shi_tomasi_detector(feature_params):
+    """
+    Input:
+    feature_params: parameters of cv2.goodFeaturesToTrack
+
+    Output:
+    detect(gray, mask, max_corners): corner detector returning an N*1*2 float32 array
+    """
+
+    def detect(gray, mask, max_corners):
+        params = dict(feature_params, maxCorners=max_corners)
+        pts = cv2.goodFeaturesToTrack(gray, mask=mask, **params)
+        return np.zeros((0, 1, 2), np.float32) if pts is None else pts
+
+    return detect
+
+
+class FeatureTracker(object):
+    """
+    Persistent KLT feature tracks: the points tracked into the current frame are carried forward as the
+    next frame's points, and new corners are only detected when the tracks run low or leave parts of the
+    frame empty.
+
+    Re-detection runs over the whole frame (away from the surviving tracks) when fewer than min_features
+    tracks survive, or on the ROI crops of the grid x grid buckets holding fewer than min_cell_features
+    tracks, topping the tracks up to max_features. A cell where detection still finds too few corners
+    (e.g. sky or a flat wall) is left alone for empty_cell_skip frames instead of being searched again
+    on every frame.
+    """
+
+    def __init__(self, detect, flow_params, max_features=400, min_features=200, grid=4, min_cell_features=1, min_distance=7, empty_cell_skip=30):
+        self.detect = detect
+        self.flow_params = flow_params
+        self.max_features = max_features
+        self.min_features = min_features
+        self.grid = grid
+        self.min_cell_features = min_cell_features
+        self.min_distance = min_distance
+        self.empty_cell_skip = empty_cell_skip
+        self.points = None
+        self.frame = 0  # number of frames seen by _top_up
+        self.skip_until = np.zeros((grid, grid), int)  # cells are not searched before this frame
+        self.detections = 0  # number of frames corner detection ran on
+
+    def _cell_edges(self, height, width):
+        return np.linspace(0, height, self.grid + 1).astype(int), np.linspace(0, width, self.grid + 1).astype(int)
+
+    def _cell_counts(self, pts, height, width):
+        cx = np.clip((pts[:, 0, 0] * self.grid / width).astype(int), 0, self.grid - 1)
+        cy = np.clip((pts[:, 0, 1] * self.grid / height).astype(int), 0, self.grid - 1)
+        return np.bincount(cy * self.grid + cx, minlength=self.grid * self.grid).reshape(self.grid, self.grid)
+
+    def _skip_empty_cells(self, pts, height, width):
+        # cells detection could not fill are not searched again for a while
+        empty = self._cell_counts(pts, height, width) < self.min_cell_features
+        self.skip_until[empty] = self.frame + self.empty_cell_skip
+
+    def _detect_cell(self, gray, pts, y0, y1, x0, x1, max_corners):
+        """
+        Output:
+        new_pts: N*1*2 float32 corners inside the cell [y0, y1) x [x0, x1) and away from pts, detected on
+        the cell's crop with a min_distance margin of context around it, in frame coordinates
+        """
+
+        height, width = gray.shape[:2]
+        margin = self.min_distance
+        top, left = max(y0 - margin, 0), max(x0 - margin, 0)
+        bottom, right = min(y1 + margin, height), min(x1 + margin, width)
+
+        mask = np.zeros((bottom - top, right - left), np.uint8)
+        mask[y0 - top:y1 - top, x0 - left:x1 - left] = 255
+        # keep new corners away from the surviving tracks
+        near = (pts[:, 0, 0] >= left - margin) & (pts[:, 0, 0] < right + margin) & (pts[:, 0, 1] >= top - margin) & (pts[:, 0, 1] < bottom + margin)
+        for x, y in pts[near, 0, :]:
+            cv2.circle(mask, (int(x) - left, int(y) - top), margin, 0, -1)
+
+        new_pts = self.detect(gray[top:bottom, left:right], mask, max_corners).astype(np.float32).reshape(-1, 1, 2)
+        return new_pts + np.array([left, top], np.float32)
+
+    def _top_up(self, gray):
+        height, width = gray.shape[:2]
+        pts = self.points
+        self.frame += 1
+        if pts is None or len(pts) == 0:
+            self.detections += 1
+            pts = self.detect(gray, None, self.max_features)
+            self._skip_empty_cells(pts, height, width)
+            return pts
+
+        counts = self._cell_counts(pts, height, width)
+        sparse = (counts < self.min_cell_features) & (self.skip_until <= self.frame)
+        if len(pts) >= self.min_features and not sparse.any():
+            return pts
+        if len(pts) >= self.max_features:
+            return pts
+
+        self.detections += 1
+        if len(pts) < self.min_features:
+            # depleted tracks, search the whole frame
+            mask = np.full((height, width), 255, np.uint8)
+            for x, y in pts[:, 0, :]:
+                cv2.circle(mask, (int(x), int(y)), self.min_distance, 0, -1)
+            new_pts = self.detect(gray, mask, self.max_features - len(pts)).astype(np.float32).reshape(-1, 1, 2)
+            pts = np.concatenate((pts, new_pts), axis=0)
+            self._skip_empty_cells(pts, height, width)
+            return pts
+
+        # only look for corners in the crops of the empty grid cells, sharing the remaining budget
+        ys, xs = self._cell_edges(height, width)
+        cells = list(zip(*np.nonzero(sparse)))
+        budget = self.max_features - len(pts)
+        per_cell = max(-(-budget // len(cells)), 1)
+        new_pts = []
+        for i, j in cells:
+            cell_pts = self._detect_cell(gray, pts, ys[i], ys[i+1], xs[j], xs[j+1], min(per_cell, budget))
+            budget -= len(cell_pts)
+            if counts[i, j] + len(cell_pts) < self.min_cell_features:
+                self.skip_until[i, j] = self.frame + self.empty_cell_skip
+            new_pts.append(cell_pts)
+            if budget <= 0:
+                break
+        return np.concatenate([pts] + new_pts, axis=0)
+
+    def track(self, prev_gray, curr_gray):
+        """
+        Input:
+        prev_gray, curr_gray: consecutive grayscale frames
+
+        Output:
+        prev_pts, curr_pts: N*2 arrays of the tracks found in both frames
+        """
+
+        prev_pts = self._top_up(prev_gray)
+        if len(prev_pts) == 0:
+            self.points = None
+            return prev_pts.reshape(-1, 2), prev_pts.reshape(-1, 2)
+
+        curr_pts, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, curr_gray, prev_pts, None, **self.flow_params)
+
+        good = status[:, 0] == 1
+        prev_pts, curr_pts = prev_pts[good], curr_pts[good]
+
+        # surviving tracks inside the frame become the next frame's points
+        height, width = curr_gray.shape[:2]
+        inside = (curr_pts[:, 0, 0] >= 0) & (curr_pts[:, 0, 0] < width) & (curr_pts[:, 0, 1] >= 0) & (curr_pts[:, 0, 1] < height)
+        self.points = curr_pts[inside]
+
+        return prev_pts.reshape(-1, 2), curr_pts.reshape(-1, 2)
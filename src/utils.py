@@ -3,10 +3,13 @@ import os
 import time
 
 import cv2
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import numpy as np
 from PIL import Image
 
+from profiling import span
+
 
 def mkdir_if_not_exist(input_dir):
     flag = os.path.exists(input_dir)
@@ -15,24 +18,11 @@ def mkdir_if_not_exist(input_dir):
         print("New Directory:", input_dir)
 
 
-def l2_dst(a, b):
-    a, b = a.flatten(), b.flatten()
-    return np.sqrt((a[0] - b[0])**2 + (a[1] - b[1])**2)
-
-
 def ffmpeg_video(img_dir, output_dir = './', video_name = 'coarse_stab.avi'):
     cmd = "ffmpeg -r 25 -i " + img_dir + "/%5d.png -pix_fmt yuv420p -b 20M " + output_dir + video_name
     os.system(cmd)
 
 
-def init_dict(cols, rows):
-    dict = {}
-    for i in range(rows):
-        for j in range(cols):
-            dict[i, j] = [[0]]
-    return dict
-
-
 def gaussian_kernel(t, r, window_size):
     if np.abs(r-t) > window_size:
         return 0
@@ -52,11 +42,23 @@ def gaussian_window(time_window_size, spatial_window_size):
     return window
 
 
+def gaussian_band(spatial_window_size):
+    """
+    Output:
+    offsets, weights: the column offsets j of gaussian_window (window[i, i+j] = weight) and their weights,
+    i.e. the non-zero band of the window without building the full matrix; the offsets run from
+    -spatial_window_size//2 to spatial_window_size//2 like gaussian_window, so they are asymmetric for odd sizes
+    """
+    offsets = np.array([j for j in range(-spatial_window_size//2, spatial_window_size//2 + 1) if j != 0])
+    return offsets, np.array([gaussian_kernel(0, j, spatial_window_size) for j in offsets])
+
+
 def timer(func):
     def func_wrapper(*args, **kwargs):
 
         time_start = time.time()
-        result = func(*args, **kwargs)
+        with span(func.__name__):
+            result = func(*args, **kwargs)
         time_end = time.time()
         time_spend = time_end - time_start
         print('{0} cost time {1} s'.format(func.__name__, time_spend))
@@ -64,6 +66,22 @@ def timer(func):
     return func_wrapper
 
 
+def plot_vertex_path(x_path, opt_x_path, save_name):
+    """
+    Input:
+    x_path: original motion of one patch vertex
+    opt_x_path: optimized motion of the same vertex
+    save_name: png file the plot is saved to
+    """
+    # figure without pyplot state, so that plots can be rendered from worker threads
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.plot(x_path)
+    ax.plot(opt_x_path)
+    fig.savefig(save_name)
+
+
 def plot_vertex_motion(x_paths, opt_x_paths, save_path):
     """
     Input:
@@ -73,21 +91,31 @@ def plot_vertex_motion(x_paths, opt_x_paths, save_path):
     # plot some vertex paths
     for i in range(x_paths.shape[0]):
         for j in range(0, x_paths.shape[1], 10):
-            plt.plot(x_paths[i, j, :])
-            plt.plot(opt_x_paths[i, j, :])
-            plt.savefig(save_path + str(i) + '_' + str(j) + '.png')
-            plt.clf()
+            plot_vertex_path(x_paths[i, j, :], opt_x_paths[i, j, :], save_path + str(i) + '_' + str(j) + '.png')
 
 
-def save_motion_vectors(x_motion_patch, y_motion_patch, PATCH_SIZE, x_motion_vector_path, frame_num, frame, r=5):
-    for i in range(x_motion_patch.shape[0]):
-        for j in range(x_motion_patch.shape[1]):
-            x, y = j * PATCH_SIZE, i * PATCH_SIZE
-            theta = np.arctan2(y_motion_patch[i, j], x_motion_patch[i, j])
-            cv2.line(frame, (x, y), (int(x + r * np.cos(theta)),int(y + r * np.sin(theta))), color=(0, 0, 255), thickness=1)
+def draw_motion_vectors(x_motion_patch, y_motion_patch, PATCH_SIZE, frame, r=5):
+    """
+    Draw the direction of the motion vector of every mesh vertex on frame, as r pixel long lines
+    drawn with a single cv2.polylines call.
+    """
+    ys, xs = np.mgrid[0:x_motion_patch.shape[0], 0:x_motion_patch.shape[1]] * PATCH_SIZE
+    theta = np.arctan2(y_motion_patch, x_motion_patch)
+    x_end = (xs + r * np.cos(theta)).astype(np.int32)
+    y_end = (ys + r * np.sin(theta)).astype(np.int32)
 
+    lines = np.stack((np.stack((xs, ys), axis=-1), np.stack((x_end, y_end), axis=-1)), axis=-2)
+    lines = lines.reshape(-1, 2, 2).astype(np.int32)
+    cv2.polylines(frame, list(lines), isClosed=False, color=(0, 0, 255), thickness=1)
+
+    return frame
+
+
+def save_motion_vectors(x_motion_patch, y_motion_patch, PATCH_SIZE, x_motion_vector_path, frame_num, frame, r=5):
+    draw_motion_vectors(x_motion_patch, y_motion_patch, PATCH_SIZE, frame, r)
     cv2.imwrite(x_motion_vector_path + str(frame_num).zfill(5)+'.png', frame)
 
+
 def batch_resize(input_dir, output_dir, width=640, height=360):
     
     def convert_img_name(image, output_dir, width, height):
@@ -1,27 +1,49 @@
+import argparse
+
 from vidstab import VidStab
 import matplotlib.pyplot as plt
 
-def main():
-    # Using defaults
 
-    stabilizer = VidStab()
-    stabilizer.stabilize(input_path='../data/Regular/5.avi', output_path='vidstab.avi')
+def vidstab_stabilize(input_path, output_path, kp_method='GFTT', plot_dir=''):
+    """
+    Input:
+    input_path: video to stabilize
+    output_path: stabilized video written by VidStab
+    kp_method: keypoint detector of VidStab, e.g. 'GFTT', 'ORB' or 'FAST'
+    plot_dir: directory of the trajectory and transform plots, no plots when empty
+    """
 
-    # Using a specific keypoint detector
-    # stabilizer = VidStab(kp_method = 'ORB')
-    # stabilizer.stabilize(input_path = 'input_video.mov', output_path = 'stable_video.avi')
+    stabilizer = VidStab(kp_method=kp_method)
+    stabilizer.stabilize(input_path=input_path, output_path=output_path)
 
     # Using a specific keypoint detector and customizing keypoint parameters
     # stabilizer = VidStab(kp_method = 'FAST', threshold = 42, nonmaxSuppression = False)
     # stabilizer.stabilize(input_path = 'input_video.mov', output_path = 'stable_video.avi')
 
-    stabilizer.plot_trajectory()
-    plt.savefig('./vidstab_trajectory.png')
-    plt.clf()
+    if plot_dir:
+        stabilizer.plot_trajectory()
+        plt.savefig(plot_dir + 'vidstab_trajectory.png')
+        plt.clf()
+
+        stabilizer.plot_transforms()
+        plt.savefig(plot_dir + 'vidstab_transforms.png')
+        plt.clf()
+
 
-    stabilizer.plot_transforms()
-    plt.savefig('./vidstab_transforms.png')
-    plt.clf()
+def get_parser():
+    parser = argparse.ArgumentParser(description='VidStab baseline')
+
+    parser.add_argument('--input_video', default='../data/Regular/5.avi', type=str)
+    parser.add_argument('--output_path', default='vidstab.avi', type=str)
+    parser.add_argument('--kp_method', default='GFTT', type=str, help='keypoint detector of VidStab')
+    parser.add_argument('--plot_dir', default='./', type=str, help='trajectory and transform plots are saved here, empty for no plots')
+
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    vidstab_stabilize(args.input_video, args.output_path, args.kp_method, args.plot_dir)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()